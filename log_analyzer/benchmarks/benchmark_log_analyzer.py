@@ -0,0 +1,267 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+try:
+    from log_analyzer import log_analyzer
+    from log_analyzer.benchmarks import log_generator
+
+except ImportError as error:
+    print "Для работы бенчмарков установите пакет log_analyzer"
+    raise error
+
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(log_analyzer.__file__)), "report.html")
+NGINX_REGEXP = log_analyzer.regexprs["NGINX_REGEXP"]
+
+
+def bench_read(paths, file_type, **kwargs):
+    log_full_name = paths["gz"] if file_type == '.gz' else paths["plain"]
+    return sum(1 for _ in log_analyzer.read_log(log_full_name, file_type, **kwargs))
+
+
+def bench_collect(paths, parser_type="regex", aggregation="exact", workers=1, url_normalizer=None, dimensions=None):
+    cfg = {"AGGREGATION": aggregation, "SKETCH_RELATIVE_ACCURACY": 0.01, "SKETCH_MAX_BUCKETS": 2048}
+    accumulator_factory = log_analyzer.get_accumulator_factory(cfg)
+    if workers > 1:
+        partial = log_analyzer.collect_statistic_parallel(paths["plain"], NGINX_REGEXP, workers, accumulator_factory,
+                                                          parser_type, url_normalizer=url_normalizer,
+                                                          dimensions=dimensions)
+    else:
+        log_iterator = log_analyzer.read_log(paths["plain"], None, decode=parser_type == "regex")
+        partial = log_analyzer.collect_statistic(log_iterator, NGINX_REGEXP, accumulator_factory, parser_type,
+                                                 url_normalizer, dimensions)
+    return partial.requests_count
+
+
+def bench_convert(paths):
+    meta = log_analyzer.convert_log(paths["gz"], '.gz', os.path.join(paths["dir"], "columns"), gzip_reader="zlib")
+    return meta["lines"]
+
+
+def bench_columns(paths, aggregation="exact", dimensions=None):
+    columns_dir = os.path.join(paths["dir"], "columns-bench")
+    log_analyzer.convert_log(paths["plain"], None, columns_dir)
+    cfg = {"AGGREGATION": aggregation, "SKETCH_RELATIVE_ACCURACY": 0.01, "SKETCH_MAX_BUCKETS": 2048}
+    stage = start_stage()
+    partial = log_analyzer.collect_statistic_columns(columns_dir, log_analyzer.get_accumulator_factory(cfg),
+                                                     dimensions=dimensions)
+    return partial.requests_count, stage
+
+
+def bench_finalize(paths, report_size):
+    partial = _load_partial(paths)
+    stage = start_stage()
+    log_analyzer.finalize_statistic(partial, report_size, 100)
+    return len(partial.urls), stage
+
+
+def bench_serialize(paths, report_size):
+    partial = _load_partial(paths)
+    top_urls, report = log_analyzer.finalize_statistic(partial, report_size, 100)
+    stage = start_stage()
+    log_analyzer.serialize_report_dict(top_urls, report)
+    return len(top_urls), stage
+
+
+def bench_generate_report(paths, report_size, stream=False):
+    partial = _load_partial(paths)
+    top_urls, report = log_analyzer.finalize_statistic(partial, report_size, 100)
+    report_name = os.path.join(paths["dir"], "report-bench-{}.html".format("stream" if stream else "dict"))
+    stage = start_stage()
+    if stream:
+        log_analyzer.write_report(TEMPLATE, report_name, log_analyzer.iter_report_json(top_urls, report))
+    else:
+        log_analyzer.generate_report(TEMPLATE, report_name, log_analyzer.serialize_report_dict(top_urls, report))
+    return len(top_urls), stage
+
+
+def start_stage():
+    """
+    Отмечает начало измеряемой стадии после подготовки: время и пиковое потребление памяти процесса на этот момент.
+    Бенчмарк с подготовкой возвращает эту отметку вместе с количеством обработанных элементов
+    :return tuple:
+    """
+
+    return time.time(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _load_partial(paths):
+    log_iterator = log_analyzer.read_log(paths["plain"], None, decode=False)
+    return log_analyzer.collect_statistic(log_iterator, NGINX_REGEXP, parser_type="fast")
+
+
+# Название, стадия, функция, параметры
+BENCHMARKS = [
+    ("read_plain_io", "read_log", bench_read, {"file_type": None, "decode": False}),
+    ("read_plain_io_decode", "read_log", bench_read, {"file_type": None}),
+    ("read_plain_mmap", "read_log", bench_read, {"file_type": None, "decode": False, "plain_reader": "mmap"}),
+    ("read_gz_gzip", "read_log", bench_read, {"file_type": '.gz', "decode": False}),
+    ("read_gz_zlib", "read_log", bench_read, {"file_type": '.gz', "decode": False, "gzip_reader": "zlib"}),
+    ("read_gz_thread", "read_log", bench_read, {"file_type": '.gz', "decode": False, "gzip_reader": "thread"}),
+    ("read_gz_process", "read_log", bench_read, {"file_type": '.gz', "decode": False, "gzip_reader": "process"}),
+    ("collect_regex_exact", "calculate_statistic", bench_collect, {}),
+    ("collect_fast_exact", "calculate_statistic", bench_collect, {"parser_type": "fast"}),
+    ("collect_fast_sketch", "calculate_statistic", bench_collect, {"parser_type": "fast", "aggregation": "sketch"}),
+    ("collect_fast_normalized", "calculate_statistic", bench_collect,
+     {"parser_type": "fast", "url_normalizer": log_analyzer.UrlNormalizer(strip_query=True, replace_ids=True)}),
+    ("collect_dimensions_sketch", "calculate_statistic", bench_collect,
+     {"parser_type": "fast", "aggregation": "sketch",
+      "dimensions": log_analyzer.Dimensions(["status_class", "time_bucket"])}),
+    ("collect_fast_parallel", "calculate_statistic", bench_collect,
+     {"parser_type": "fast", "workers": multiprocessing.cpu_count()}),
+    ("convert_gz", "convert_log", bench_convert, {}),
+    ("columns_exact", "calculate_statistic", bench_columns, {}),
+    ("columns_dimensions_sketch", "calculate_statistic", bench_columns,
+     {"aggregation": "sketch", "dimensions": log_analyzer.Dimensions(["status_class", "time_bucket"])}),
+    ("finalize", "calculate_statistic", bench_finalize, {"report_size": 1000}),
+    ("serialize_report_dict", "serialize_report_dict", bench_serialize, {"report_size": 1000}),
+    ("generate_report", "generate_report", bench_generate_report, {"report_size": 1000}),
+    ("write_report_stream", "generate_report", bench_generate_report, {"report_size": 1000, "stream": True}),
+]
+
+
+def _run_in_child(function, paths, kwargs, connection):
+    stage = start_stage()
+    result = function(paths, **kwargs)
+    finished = time.time()
+    # Функция с подготовкой возвращает отметку начала своей стадии: время и память подготовки не учитываются
+    items, (started, setup_rss_kb) = result if isinstance(result, tuple) else (result, stage)
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    connection.send({
+        "items": items,
+        "seconds": finished - started,
+        "peak_rss_kb": peak_rss_kb,
+        "stage_rss_kb": peak_rss_kb - setup_rss_kb,
+        "children_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    })
+    connection.close()
+
+
+def run_benchmark(name, stage, function, paths, kwargs):
+    """
+    Запускает бенчмарк в отдельном процессе, чтобы пиковое потребление памяти относилось только к нему.
+    stage_rss_kb - прирост пика памяти за измеряемую стадию, без подготовки. Бросает RuntimeError, если бенчмарк
+    упал
+    :return dict:
+    """
+
+    parent_connection, child_connection = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_run_in_child, args=(function, paths, kwargs, child_connection))
+    process.start()
+    # Иначе recv не получит EOFError, если дочерний процесс упадёт, не отправив результат
+    child_connection.close()
+    try:
+        result = parent_connection.recv()
+    except EOFError:
+        result = None
+    finally:
+        parent_connection.close()
+        process.join()
+    if result is None or process.exitcode:
+        raise RuntimeError("Бенчмарк {} завершился с кодом {}".format(name, process.exitcode))
+    result.update({
+        "name": name,
+        "stage": stage,
+        "items_per_sec": result["items"] / result["seconds"] if result["seconds"] else None,
+    })
+    return result
+
+
+def compare(results, previous, threshold):
+    """
+    Сравнивает результаты с предыдущим запуском и возвращает список бенчмарков, ставших медленнее более
+    чем на threshold (доля)
+    :param list results:
+    :param dict previous:
+    :param float threshold:
+    :return list:
+    """
+
+    previous_results = dict((result["name"], result) for result in previous["results"])
+    regressions = []
+    for result in results:
+        old = previous_results.get(result["name"])
+        if not old or not old["seconds"]:
+            continue
+        ratio = result["seconds"] / old["seconds"]
+        mark = ""
+        if ratio > 1 + threshold:
+            regressions.append(result["name"])
+            mark = " REGRESSION"
+        print "{:<28} {:>9.3f}s -> {:>9.3f}s  x{:.2f}{}".format(result["name"], old["seconds"], result["seconds"],
+                                                               ratio, mark)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=u"Бенчмарки стадий анализатора логов")
+    parser.add_argument('--lines', type=int, default=200000, help=u'Количество строк синтетического лога.')
+    parser.add_argument('--urls', type=int, default=10000, help=u'Количество различных url.')
+    parser.add_argument('--skew', type=float, default=1.1, help=u'Параметр распределения Ципфа.')
+    parser.add_argument('--malformed', type=float, default=0.001, help=u'Доля некорректных строк.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', default=None, help=u'Запускать только бенчмарки, содержащие эту подстроку.')
+    parser.add_argument('--output', default=None, help=u'Файл для сохранения результатов в JSON.')
+    parser.add_argument('--compare', default=None, help=u'JSON с результатами предыдущего запуска.')
+    parser.add_argument('--threshold', type=float, default=0.1, help=u'Допустимое замедление, доля.')
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        paths = {"dir": temp_dir,
+                 "plain": os.path.join(temp_dir, "nginx-access-ui.log-20170629"),
+                 "gz": os.path.join(temp_dir, "nginx-access-ui.log-20170629.gz")}
+        for path, compress in ((paths["plain"], False), (paths["gz"], True)):
+            log_generator.generate_log(path, args.lines, args.urls, args.skew, args.malformed, args.seed, compress)
+
+        results = []
+        failed = []
+        for name, stage, function, kwargs in BENCHMARKS:
+            if args.only and args.only not in name:
+                continue
+            try:
+                result = run_benchmark(name, stage, function, paths, kwargs)
+            except RuntimeError as error:
+                print error
+                failed.append(name)
+                continue
+            results.append(result)
+            print "{:<28} {:>9.3f}s {:>12.0f}/s {:>9d} KB".format(name, result["seconds"], result["items_per_sec"] or 0,
+                                                                  result["stage_rss_kb"])
+    finally:
+        shutil.rmtree(temp_dir)
+
+    report = {
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "params": {"lines": args.lines, "urls": args.urls, "skew": args.skew, "malformed": args.malformed,
+                   "seed": args.seed},
+        "results": results,
+        "failed": failed,
+    }
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            if compare(results, json.load(previous_file), args.threshold):
+                sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import argparse
+import bisect
+import gzip
+import io
+import random
+from datetime import datetime, timedelta
+
+
+# Шаблоны адресов, похожие на реальные url из логов ui_short. Каждый содержит {id}, чтобы различных url
+# можно было получить сколько угодно
+URL_TEMPLATES = [
+    "/api/v2/banner/{id}",
+    "/api/v2/banner/{id}/statistic/?date_from=2017-06-{day:02d}",
+    "/api/v2/group/{id}/banners",
+    "/api/v2/slot/{id}/groups",
+    "/api/v2/internal/banner/{id}/info",
+    "/api/1/photogenic_banners/list/?server_name=WIN7RB{id}",
+    "/export/appinstall_raw/2017-06-{day:02d}/?offset={id}",
+]
+
+USER_AGENTS = [
+    "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5",
+    "Python-urllib/2.7",
+    "python-requests/2.13.0",
+    "Slotovod",
+    "Configovod",
+]
+
+METHODS = ["GET"] * 8 + ["POST", "HEAD"]
+STATUSES = [200] * 18 + [404, 502]
+
+
+def make_urls(count, rnd):
+    """
+    Возвращает список из count различных url
+    :param int count:
+    :param random.Random rnd:
+    :return list:
+    """
+
+    urls = []
+    seen = set()
+    while len(urls) < count:
+        template = URL_TEMPLATES[len(urls) % len(URL_TEMPLATES)]
+        url = template.format(id=rnd.randint(1, 10 ** 8), day=rnd.randint(1, 30))
+        if url not in seen:
+            seen.add(url)
+            urls.append(url)
+    return urls
+
+
+def make_zipf_sampler(count, skew, rnd):
+    """
+    Возвращает функцию, выбирающую индекс от 0 до count - 1 по закону Ципфа с параметром skew
+    :param int count:
+    :param float skew:
+    :param random.Random rnd:
+    :return:
+    """
+
+    cumulative = []
+    total = 0.0
+    for rank in xrange(1, count + 1):
+        total += 1.0 / rank ** skew
+        cumulative.append(total)
+
+    def sample():
+        return bisect.bisect_left(cumulative, rnd.random() * total)
+
+    return sample
+
+
+def generate_lines(lines, urls=1000, skew=1.1, malformed_rate=0.001, seed=0, start=datetime(2017, 6, 29)):
+    """
+    Функция - генератор. Детерминированно (при одинаковых параметрах) генерирует строки лога в формате ui_short
+    :param int lines: количество строк
+    :param int urls: количество различных url
+    :param float skew: параметр распределения Ципфа для популярности url
+    :param float malformed_rate: доля строк, не подходящих под формат
+    :param int seed:
+    :param datetime start: время первой записи
+    """
+
+    rnd = random.Random(seed)
+    url_list = make_urls(urls, rnd)
+    sample_url = make_zipf_sampler(urls, skew, rnd)
+
+    for number in xrange(lines):
+        moment = start + timedelta(seconds=number * 86400 // max(lines, 1))
+        if rnd.random() < malformed_rate:
+            yield "{}.{}.{}.{} - - [{}] broken line {}\n".format(rnd.randint(1, 255), rnd.randint(0, 255),
+                                                                 rnd.randint(0, 255), rnd.randint(0, 255),
+                                                                 moment.strftime("%d/%b/%Y:%H:%M:%S +0300"),
+                                                                 number)
+            continue
+        yield ('{ip} {user}  - [{time_local}] "{method} {url} HTTP/1.1" {status} {size} "-" "{agent}" "-" '
+               '"{request_id}" "{rb_user}" {request_time:.3f}\n').format(
+            ip="1.{}.{}.{}".format(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)),
+            user=rnd.choice(["-", "3b81f63526fa8"]),
+            time_local=moment.strftime("%d/%b/%Y:%H:%M:%S +0300"),
+            method=rnd.choice(METHODS),
+            url=url_list[sample_url()],
+            status=rnd.choice(STATUSES),
+            size=rnd.randint(0, 30000),
+            agent=rnd.choice(USER_AGENTS),
+            request_id="{}-{}-4708-{}".format(1498697422 + number // 1000, rnd.randint(0, 2 ** 32), number),
+            rb_user=rnd.choice(["-", "712e90144abee9", "dc7161be3"]),
+            request_time=rnd.lognormvariate(-2.0, 1.0),
+        )
+
+
+def generate_log(path, lines, urls=1000, skew=1.1, malformed_rate=0.001, seed=0, compress=False):
+    """
+    Записывает сгенерированный лог в файл path, при compress=True - в формате gzip
+    :param str path:
+    :param int lines:
+    :param int urls:
+    :param float skew:
+    :param float malformed_rate:
+    :param int seed:
+    :param bool compress:
+    :return str: путь к файлу
+    """
+
+    f_open = gzip.open if compress else io.open
+    with f_open(path, mode='wb') as log_file:
+        for line in generate_lines(lines, urls, skew, malformed_rate, seed):
+            log_file.write(line)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=u"Генератор синтетических логов в формате ui_short")
+    parser.add_argument('path', help=u'Путь к файлу лога.')
+    parser.add_argument('--lines', type=int, default=100000, help=u'Количество строк.')
+    parser.add_argument('--urls', type=int, default=1000, help=u'Количество различных url.')
+    parser.add_argument('--skew', type=float, default=1.1, help=u'Параметр распределения Ципфа.')
+    parser.add_argument('--malformed', type=float, default=0.001, help=u'Доля некорректных строк.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gz', action='store_true', help=u'Сжать лог в gzip.')
+    args = parser.parse_args()
+    generate_log(args.path, args.lines, args.urls, args.skew, args.malformed, args.seed, args.gz)
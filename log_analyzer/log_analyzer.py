@@ -3,7 +3,7 @@
 
 import os
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 import gzip
 import io
 from collections import defaultdict, namedtuple
@@ -11,7 +11,40 @@ import logging
 import argparse
 import json
 from string import Template
+from array import array
 import tempfile
+import shutil
+import multiprocessing
+import math
+import functools
+import sqlite3
+import cPickle
+import zlib
+import time
+import threading
+import Queue
+import BaseHTTPServer
+import SocketServer
+import urlparse
+import subprocess
+import mmap
+import itertools
+import heapq
+import operator
+import calendar
+import sys
+import contextlib
+import resource
+import cProfile
+from distutils.spawn import find_executable
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Бэкпорт os.scandir для python 2
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 
 # log_format ui_short '$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
@@ -29,6 +62,39 @@ config = {
     "MAX_ERRORS_PERCENT": 1,
     "LOG_FORMAT": "%(asctime)s %(levelname).1s %(message)s",
     "LOG_DATEFMT": "%Y.%m.%d,%H:%M:%S",
+    "WORKERS": 1,
+    "PARSER": "regex",
+    "GZIP_READER": "gzip",
+    "GZIP_BLOCK_SIZE": 1 << 20,
+    "PLAIN_READER": "io",
+    "URL_STRIP_QUERY": False,
+    "URL_REPLACE_IDS": False,
+    "URL_REWRITES": [],
+    "URL_CACHE_SIZE": 100000,
+    "AGGREGATION": "exact",
+    "SKETCH_RELATIVE_ACCURACY": 0.01,
+    "SKETCH_MAX_BUCKETS": 2048,
+    "AGGREGATE_CACHE": None,
+    "REPORT_DAYS": 1,
+    "FOLLOW_LOG": "nginx-access-ui.log",
+    "FOLLOW_CHECKPOINT": "./reports/follow.checkpoint",
+    "FOLLOW_INTERVAL": 60,
+    "FOLLOW_CHECKPOINT_INTERVAL": 600,
+    "BACKFILL_WORKERS": 4,
+    "METRICS_FORMAT": None,
+    "REPORT_DIMENSIONS": [],
+    "REPORT_TIME_BUCKET": 60,
+    "REPORT_PERCENTILES": [],
+    "COLUMNS_DIR": None,
+    "DISCOVERY_STATE": None,
+    "SERVICE_HOST": "127.0.0.1",
+    "SERVICE_PORT": 8080,
+    "ERRORS_MIN_LINE_BYTES": 10,
+    "ERRORS_GZ_MIN_LINES": 100000,
+    "ERRORS_Z": 4.0,
+    "PREFLIGHT_SAMPLES": 0,
+    "QUARANTINE_DIR": None,
+    "QUARANTINE_MAX_LINES": 1000,
 }
 
 default_cfg_file = "config.cfg"
@@ -36,193 +102,2053 @@ default_cfg_file = "config.cfg"
 regexprs = {
     "LOG_NAME_REGEXP": r'^nginx-access-ui\.log-(\d{8})(\.gz){0,1}$',
     "NGINX_REGEXP": r'\"[A-Z]+\s(?P<url>[\S]+)\s.+\"\s(?P<time>\S+)$',
+    "NGINX_DIMENSIONS_REGEXP": r'\[(?P<time_local>\d\d/\w+/\d{4}:\d\d:\d\d:\d\d[^\]]*)\]\s'
+                               r'\"(?P<method>[A-Z]+)\s(?P<url>[\S]+)\s[^\"]*\"\s(?P<status>\d{3})\s'
+                               r'.+\"\s(?P<time>\S+)$',
 }
 
 NginxLog = namedtuple('NginxLog', ['name', 'date', 'extension'])
+PartialStatistic = namedtuple('PartialStatistic', ['requests_count', 'requests_time', 'mismatch_count', 'urls',
+                                                   'groups'])
+# Статистики без группировок (в том числе сохранённые в хранилище до их появления) имеют groups = None
+PartialStatistic.__new__.__defaults__ = (None,)
+
+
+def list_dir(log_dir):
+    """
+    Функция - генератор. Возвращает имена файлов папки по мере чтения каталога (через scandir, если он доступен),
+    не собирая список всех имён
+    :param str log_dir:
+    """
+
+    if scandir is None:
+        for file_name in os.listdir(log_dir):
+            yield file_name
+    else:
+        for entry in scandir(log_dir):
+            yield entry.name
+
+
+def scan_log_names(log_dir, regexp):
+    """
+    Функция - генератор. Возвращает имя лога, дату строкой YYYYMMDD и расширение для файлов папки log_dir,
+    подходящих под regexp. Даты не разбираются: строки YYYYMMDD сравниваются так же, как даты
+    :param str log_dir:
+    :param str regexp:
+    """
+
+    search = re.compile(regexp).search
+    for file_name in list_dir(log_dir):
+        match = search(file_name)
+        if match:
+            yield match.group(0), match.group(1), match.group(2)
+
+
+def is_preferred_log(log_ext, other_ext):
+    """
+    Выбор между логами за одну дату: несжатый лог предпочтительнее сжатого - он уже полностью записан
+    (сжатая копия может быть ещё не дописана при ротации) и читается быстрее
+    :param str log_ext:
+    :param str other_ext:
+    :return bool:
+    """
+
+    return other_ext == '.gz' and log_ext != '.gz'
+
+
+def get_logs_by_date(log_dir, regexp, first_date=None, last_date=None):
+    """
+    Возвращает по одному логу на каждую дату в интервале [first_date, last_date] (строки YYYYMMDD,
+    None - без ограничения): {дата строкой: (имя лога, расширение)}
+    :param str log_dir:
+    :param str regexp:
+    :param str first_date:
+    :param str last_date:
+    :return dict:
+    """
+
+    logs = {}
+    for log_name, raw_date, log_ext in scan_log_names(log_dir, regexp):
+        if (first_date and raw_date < first_date) or (last_date and raw_date > last_date):
+            continue
+        current = logs.get(raw_date)
+        if current is None or is_preferred_log(log_ext, current[1]):
+            logs[raw_date] = log_name, log_ext
+    return logs
+
+
+def parse_log_date(raw_date):
+    """
+    Разбирает дату лога вида YYYYMMDD
+    :param str raw_date:
+    :return datetime:
+    """
+
+    try:
+        return datetime.strptime(raw_date, '%Y%m%d')
+    except ValueError as error:
+        logging.error(u"Ошибка парсинга даты.{}\n Завершаем работу.".format(error))
+        raise error
 
 
 def get_recent_log(log_dir, regexp):
     """
     Ищет в директории log_dir логи согласно регулярному выражению regexp
-    И возвращает самый новый, согласно дате создания
+    И возвращает самый новый, согласно дате создания. Даты сравниваются строками YYYYMMDD, разбирается
+    только дата найденного лога. Если за эту дату есть и сжатый, и несжатый лог, то возвращается несжатый
     :param str log_dir:
     :param str regexp:
     :return:
     """
 
-    files = os.listdir(log_dir)
-    logs_names_gen = match_log_name(files, regexp)
+    recent_log = None
+    for log_name, raw_date, log_ext in scan_log_names(log_dir, regexp):
+        if recent_log is None or raw_date > recent_log[1] or \
+                (raw_date == recent_log[1] and is_preferred_log(log_ext, recent_log[2])):
+            recent_log = log_name, raw_date, log_ext
+
+    if recent_log is None:
+        return
+    # Возвращаем имя лога, дату создания, расширение файла
+    return NginxLog(recent_log[0], parse_log_date(recent_log[1]), recent_log[2])
+
+
+def read_gzip_blocks(log_full_name, block_size):
+    """
+    Функция - генератор. Распаковывает gz файл через zlib большими блоками, без построчного чтения модуля gzip.
+    Поддерживает файлы из нескольких склеенных gzip-потоков и, как модуль gzip, нулевые байты между потоками
+    и в конце файла
+    :param str log_full_name:
+    :param int block_size:
+    """
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # Закончился gzip-поток, а следующий ещё не начался: нулевые байты пропускаются
+    padding = False
+    with io.open(log_full_name, mode='rb') as log_file:
+        while True:
+            data = log_file.read(block_size)
+            if not data:
+                break
+            if padding:
+                data = data.lstrip('\0')
+            while data:
+                padding = False
+                yield decompressor.decompress(data)
+                # Закончился очередной gzip-поток - остаток данных принадлежит следующему
+                data = decompressor.unused_data
+                if data:
+                    yield decompressor.flush()
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    data = data.lstrip('\0')
+                    padding = True
+        yield decompressor.flush()
+
+
+def read_gzip_blocks_threaded(log_full_name, block_size, queue_size=8):
+    """
+    Функция - генератор. Распаковывает gz файл в отдельном потоке, чтобы разбор строк шёл параллельно
+    с распаковкой (zlib отпускает GIL на время распаковки)
+    :param str log_full_name:
+    :param int block_size:
+    :param int queue_size:
+    """
+
+    blocks = Queue.Queue(maxsize=queue_size)
+    # Выставляется, если чтение прекращено раньше конца файла (например, из-за слишком большого числа ошибок)
+    stop = threading.Event()
+
+    def decompress():
+        try:
+            for block in read_gzip_blocks(log_full_name, block_size):
+                if stop.is_set():
+                    break
+                blocks.put(block)
+        except Exception as error:
+            blocks.put(error)
+        blocks.put(None)
+
+    thread = threading.Thread(target=decompress)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        # Освобождаем очередь, чтобы поток не остался навсегда заблокирован на put с открытым файлом
+        while thread.is_alive():
+            try:
+                while True:
+                    blocks.get_nowait()
+            except Queue.Empty:
+                thread.join(0.01)
+
+
+def read_gzip_blocks_process(log_full_name, block_size):
+    """
+    Функция - генератор. Распаковывает gz файл внешней программой pigz или gzip в отдельном процессе.
+    Если ни одной из них нет, распаковывает в отдельном потоке
+    :param str log_full_name:
+    :param int block_size:
+    """
+
+    command = find_executable("pigz") or find_executable("gzip")
+    if command is None:
+        for block in read_gzip_blocks_threaded(log_full_name, block_size):
+            yield block
+        return
+
+    process = subprocess.Popen([command, "-dc", log_full_name], stdout=subprocess.PIPE, bufsize=block_size)
+    try:
+        while True:
+            block = process.stdout.read(block_size)
+            if not block:
+                break
+            yield block
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        if process.wait() > 0:
+            raise IOError("{} завершился с кодом {}".format(command, process.returncode))
+
+
+def read_mmap_blocks(log_full_name, block_size, start=0, end=None):
+    """
+    Функция - генератор. Отображает несжатый лог в память и возвращает куски между смещениями start и end
+    блоками примерно по block_size байт, выровненными по границам строк. Вместо копирования и декодирования
+    каждой строки файл копируется один раз целыми блоками, строки из них выделяет split_blocks
+    :param str log_full_name:
+    :param int block_size:
+    :param int start:
+    :param int end:
+    """
+
+    with io.open(log_full_name, mode='rb') as log_file:
+        file_size = os.fstat(log_file.fileno()).st_size
+        # Пустой файл отобразить в память нельзя
+        if not file_size:
+            return
+        log_map = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            end = file_size if end is None else min(end, file_size)
+            position = start
+            while position < end:
+                block_end = min(position + block_size, end)
+                if block_end < end:
+                    line_end = log_map.rfind('\n', position, block_end)
+                    # Строка длиннее блока - берём её целиком
+                    if line_end < 0:
+                        line_end = log_map.find('\n', block_end, end)
+                    block_end = end if line_end < 0 else line_end + 1
+                yield log_map[position:block_end]
+                position = block_end
+        finally:
+            log_map.close()
+
+
+gzip_readers = {
+    "zlib": read_gzip_blocks,
+    "thread": read_gzip_blocks_threaded,
+    "process": read_gzip_blocks_process,
+}
+
+
+def split_blocks(blocks):
+    """
+    Разбивает поток блоков данных на строки целыми блоками (без завершающего перевода строки).
+    Возвращает итератор по строкам
+    :param blocks:
+    :return:
+    """
+
+    return itertools.chain.from_iterable(_split_blocks_to_lists(blocks))
+
+
+def _split_blocks_to_lists(blocks):
+    tail = ''
+    for block in blocks:
+        lines = block.split('\n')
+        # Недочитанную строку предыдущего блока приклеиваем к первой строке, не копируя весь блок
+        if tail:
+            lines[0] = tail + lines[0]
+        tail = lines.pop()
+        yield lines
+    if tail:
+        yield [tail]
+
+
+def read_log(log_full_name, file_type, decode=True, gzip_reader="gzip", block_size=1 << 20, plain_reader="io"):
+    """
+    Функция - генератор. Итерируется по лог-файлу построчно
+    :param str log_full_name:
+    :param str file_type:
+    :param bool decode: декодировать строки в unicode, иначе возвращаются байты как есть
+    :param str gzip_reader: способ распаковки gz: gzip (построчно модулем gzip), zlib, thread или process
+    :param int block_size: размер блока для блочных способов чтения
+    :param str plain_reader: способ чтения несжатого лога: io (построчно) или mmap (блоками из отображения в память)
+    """
+
+    try:
+        if file_type == '.gz' and gzip_reader != "gzip":
+            blocks = gzip_readers[gzip_reader](log_full_name, block_size)
+        elif file_type != '.gz' and plain_reader == "mmap":
+            blocks = read_mmap_blocks(log_full_name, block_size)
+        else:
+            blocks = None
+
+        if blocks is not None:
+            for line in split_blocks(blocks):
+                yield line.decode('utf-8') if decode else line
+            return
+
+        f_open = gzip.open if file_type == '.gz' else io.open
+        with f_open(log_full_name, mode='r' if decode else 'rb') as log_file:
+            for line in log_file:
+                yield line.decode('utf-8') if decode else line  # Так универсальнее
+    except (IOError, zlib.error) as error:
+        logging.error(u"Проблема с чтением из лог файла: {}".format(error))
+        yield None
+
+
+def median(lst):
+    """
+    Возвращает медиану !отсортированного! списка
+    :param list lst:
+    :return float:
+    """
+
+    n = len(lst)
+    if n < 1:
+            return None
+    if n % 2 == 1:
+            return lst[n//2]
+    else:
+            return sum(lst[n//2-1:n//2+1])/2.0
+
+
+class ExactAccumulator(object):
+    """
+    Точный накопитель времени обработки для одного url: хранит все значения.
+    Значения лежат в типизированном массиве array('d') по 8 байт, а не в списке объектов float (~32 байта),
+    но память всё равно растёт вместе с количеством строк, поэтому режим подходит для небольших логов.
+    """
+
+    __slots__ = ('times', 'time_sum')
+
+    def __init__(self):
+        self.times = array('d')
+        # Текущая сумма для выбора топа, чтобы не пересчитывать её по всем значениям. В отчёт идёт точная сумма
+        # из summary, которая не зависит от порядка слагаемых
+        self.time_sum = 0
+
+    def __setstate__(self, state):
+        _, slots = state
+        for name, value in slots.iteritems():
+            setattr(self, name, value)
+        # Накопители из кеша агрегатов и контрольных точек, сохранённых без текущей суммы
+        if "time_sum" not in slots:
+            self.time_sum = math.fsum(self.times)
+
+    def add(self, request_time):
+        self.times.append(request_time)
+        self.time_sum += request_time
+
+    def merge(self, other):
+        self.times.extend(other.times)
+        self.time_sum += other.time_sum
+
+    def summary(self):
+        """
+        Возвращает количество, сумму, максимум и медиану времени обработки
+        :return tuple:
+        """
+
+        # Отсортированная копия нужна только на время подсчёта, сам массив остаётся компактным
+        times = sorted(self.times)
+        return len(times), math.fsum(times), times[-1], median(times)
+
+    def quantiles(self, qs):
+        """
+        Возвращает значения q-квантилей времени обработки для каждого q из qs: элемент с рангом floor(q * (count - 1)),
+        как и у SketchAccumulator
+        :param list qs:
+        :return list:
+        """
+
+        times = sorted(self.times)
+        return [times[int(q * (len(times) - 1))] for q in qs]
+
+
+class SketchMapping(object):
+    """
+    Общие для всех скетчей параметры логарифмических корзин (DDSketch).
+    Значение v попадает в корзину i = ceil(log(v) / log(gamma)), где gamma = (1 + a) / (1 - a),
+    а оценка 2 * gamma^i / (gamma + 1) отличается от любого значения корзины не более чем на a * v.
+    """
+
+    def __init__(self, relative_accuracy, max_buckets):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+
+    @property
+    def key(self):
+        """
+        Строка параметров корзин: скетчи с разными параметрами объединять нельзя
+        :return unicode:
+        """
+
+        return u"{!r}:{}".format(self.relative_accuracy, self.max_buckets)
+
+    def index(self, value):
+        return int(math.ceil(math.log(value) / self.log_gamma))
+
+    def value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+
+class SketchAccumulator(object):
+    """
+    Накопитель фиксированного размера для одного url: количество, сумма, максимум и квантильный скетч.
+    Число корзин ограничено mapping.max_buckets, поэтому память не зависит от количества строк.
+    Медиана - это оценка элемента с рангом floor((count - 1) / 2) с относительной погрешностью
+    не более mapping.relative_accuracy (при переполнении корзин сливаются самые младшие,
+    что может занизить точность только для малых значений).
+    """
+
+    __slots__ = ('mapping', 'count', 'time_sum', 'time_max', 'zero_count', 'buckets')
+
+    # Значения меньше этого порога (в том числе нулевое время обработки) считаем нулём
+    min_value = 1e-9
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+        self.count = 0
+        self.time_sum = 0
+        self.time_max = 0
+        self.zero_count = 0
+        self.buckets = {}
+
+    def add(self, request_time):
+        self.count += 1
+        self.time_sum += request_time
+        if request_time > self.time_max:
+            self.time_max = request_time
+        if request_time < self.min_value:
+            self.zero_count += 1
+            return
+        index = self.mapping.index(request_time)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        if len(self.buckets) > self.mapping.max_buckets:
+            self._collapse()
+
+    def merge(self, other):
+        # Индексы корзин с другим gamma означают другие значения
+        if other.mapping is not self.mapping and other.mapping.key != self.mapping.key:
+            raise ValueError("Нельзя объединить скетчи с разными параметрами: {} и {}".format(self.mapping.key,
+                                                                                            other.mapping.key))
+        self.count += other.count
+        self.time_sum += other.time_sum
+        self.time_max = max(self.time_max, other.time_max)
+        self.zero_count += other.zero_count
+        for index, bucket_count in other.buckets.iteritems():
+            self.buckets[index] = self.buckets.get(index, 0) + bucket_count
+        if len(self.buckets) > self.mapping.max_buckets:
+            self._collapse()
+
+    def _collapse(self):
+        # Сливаем самые младшие корзины в одну, чтобы уложиться в max_buckets
+        indexes = sorted(self.buckets)
+        excess = len(indexes) - self.mapping.max_buckets
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            self.buckets[target] += self.buckets.pop(index)
+
+    def quantile(self, q):
+        """
+        Возвращает оценку q-квантиля времени обработки
+        :param float q:
+        :return float:
+        """
+
+        if self.count < 1:
+            return None
+        rank = int(q * (self.count - 1))
+        if rank < self.zero_count:
+            return 0.0
+        running = self.zero_count
+        for index in sorted(self.buckets):
+            running += self.buckets[index]
+            if running > rank:
+                return min(self.mapping.value(index), self.time_max)
+        return self.time_max
+
+    def summary(self):
+        """
+        Возвращает количество, сумму, максимум и медиану (оценку) времени обработки
+        :return tuple:
+        """
+
+        return self.count, self.time_sum, self.time_max, self.quantile(0.5)
+
+    def quantiles(self, qs):
+        """
+        Возвращает оценки q-квантилей времени обработки для каждого q из qs
+        :param list qs:
+        :return list:
+        """
+
+        return [self.quantile(q) for q in qs]
+
+
+def make_regex_parser(nginx_regex):
+    """
+    Возвращает парсер строки лога на регулярном выражении с группами url и time.
+    Парсер возвращает пару строк (url, время обработки) или None, если строка не подходит под шаблон
+    :param str nginx_regex:
+    :return:
+    """
+
+    nginx_pattern = re.compile(nginx_regex)
+
+    def parse(line):
+        match = nginx_pattern.search(line)
+        if match:
+            return match.group("url"), match.group("time")
+
+    return parse
+
+
+# Оба парсера - одно и то же регулярное выражение, разница только в типе строк: regex разбирает декодированные
+# строки, fast - байты как есть, тогда url остаются байтами, и декодируются только url, попавшие в отчёт
+# (см. finalize_statistic). Разбор строки вручную (find/rfind) на CPython 2 не быстрее скомпилированного
+# регулярного выражения, а весь выигрыш fast даёт отказ от декодирования
+line_parsers = {
+    "regex": make_regex_parser,
+    "fast": make_regex_parser,
+}
+
+
+class UrlNormalizer(object):
+    """
+    Приводит url к нормализованному ключу, чтобы схлопнуть адреса с идентификаторами и параметрами:
+    отбрасывает строку запроса, заменяет числовые и шестнадцатеричные сегменты пути на {id}
+    и применяет пользовательские замены по регулярным выражениям (в указанном порядке).
+    Правила компилируются один раз, а результаты кешируются в ограниченном кеше из двух поколений
+    (приближение LRU, в котором попадание - это обычный поиск в словаре). Одинаковые ключи
+    возвращаются одним и тем же объектом строки, байтовые строки дополнительно интернируются
+    """
+
+    id_pattern = re.compile(r'/(?:\d+|(?=[0-9a-fA-F]*\d)[0-9a-fA-F]{8,})(?=[/?;]|$)')
+
+    def __init__(self, strip_query=False, replace_ids=False, rewrites=(), cache_size=100000):
+        self.strip_query = strip_query
+        self.replace_ids = replace_ids
+        self.rewrites = [(re.compile(pattern), replacement) for pattern, replacement in rewrites]
+        self.cache_size = cache_size
+        self.recent = {}
+        self.old = {}
+        # Ключ настроек: статистики с разной нормализацией не должны смешиваться
+        self.key = json.dumps([strip_query, replace_ids, list(rewrites)])
+
+    def __call__(self, url):
+        key = self.recent.get(url)
+        if key is not None:
+            return key
+        key = self.old.get(url)
+        if key is None:
+            key = self.normalize(url)
+        # Когда текущее поколение заполнено, оно становится старым, а самое старое отбрасывается
+        if len(self.recent) >= self.cache_size // 2:
+            self.old = self.recent
+            self.recent = {}
+        self.recent[url] = key
+        return key
+
+    def normalize(self, url):
+        """
+        Применяет правила нормализации к url без использования кеша
+        :param url:
+        :return:
+        """
+
+        if self.strip_query:
+            url = url.partition('?')[0]
+        if self.replace_ids:
+            url = self.id_pattern.sub('/{id}', url)
+        for pattern, replacement in self.rewrites:
+            url = pattern.sub(replacement, url)
+        return intern(url) if isinstance(url, str) else url
+
+    def __getstate__(self):
+        # Кеш не передаём в процессы-обработчики
+        return self.strip_query, self.replace_ids, self.rewrites, self.cache_size, self.key
+
+    def __setstate__(self, state):
+        self.strip_query, self.replace_ids, self.rewrites, self.cache_size, self.key = state
+        self.recent = {}
+        self.old = {}
+
+
+def get_url_normalizer(cfg):
+    """
+    Возвращает нормализатор url согласно конфигу или None, если нормализация выключена
+    :param dict cfg:
+    :return UrlNormalizer:
+    """
+
+    if cfg["URL_STRIP_QUERY"] or cfg["URL_REPLACE_IDS"] or cfg["URL_REWRITES"]:
+        return UrlNormalizer(cfg["URL_STRIP_QUERY"], cfg["URL_REPLACE_IDS"], cfg["URL_REWRITES"],
+                             cfg["URL_CACHE_SIZE"])
+
+
+class Dimensions(object):
+    """
+    Группировки строк лога по полям формата ui_short для дополнительных таблиц отчёта:
+    status - код ответа, status_class - класс ответа (2xx, 5xx), method - метод запроса,
+    time_bucket - интервал времени суток из $time_local длиной time_bucket минут.
+    Группировка может объединять несколько полей через "+", например status_class+time_bucket.
+    Статистика по всем группировкам собирается за тот же проход по логу, что и основная
+    """
+
+    fields = ("status", "status_class", "method", "time_bucket")
+
+    def __init__(self, groupings, time_bucket=60, nginx_regex=regexprs["NGINX_DIMENSIONS_REGEXP"]):
+        self.groupings = [tuple(grouping.split("+")) for grouping in groupings]
+        for grouping in self.groupings:
+            for field in grouping:
+                if field not in self.fields:
+                    raise ValueError("Неизвестное поле группировки: {}".format(field))
+        if not 0 < time_bucket <= 24 * 60:
+            raise ValueError("Неверная длина интервала времени: {}".format(time_bucket))
+        self.time_bucket = time_bucket
+        self.nginx_regex = nginx_regex
+        # Имена группировок для имён таблиц отчёта
+        self.names = ["-".join(grouping) for grouping in self.groupings]
+        # Ключ настроек: статистики с разными группировками не должны смешиваться
+        self.key = json.dumps([list(groupings), time_bucket])
+
+    def make_parser(self):
+        """
+        Возвращает парсер строки лога. Парсер возвращает url, время обработки и список ключей строки
+        (кортежей значений полей) для каждой группировки или None, если строка не подходит под шаблон
+        :return:
+        """
+
+        search = re.compile(self.nginx_regex).search
+        key_getters = self.make_key_getters()
+        # Метки интервалов по "ЧЧ:ММ" из $time_local, различных значений не больше 1440
+        bucket_labels = {}
+
+        def parse(line):
+            match = search(line)
+            if match is None:
+                return
+            url, request_time, method, status, time_local = match.group("url", "time", "method", "status",
+                                                                         "time_local")
+            # $time_local вида 29/Jun/2017:03:50:22 +0300
+            minute = time_local[12:17]
+            bucket = bucket_labels.get(minute)
+            if bucket is None:
+                bucket = bucket_labels[minute] = self.bucket_label(int(minute[:2]) * 60 + int(minute[3:]))
+            values = (status, status[0] + "xx", method, bucket)
+            return url, request_time, [key_getter(values) for key_getter in key_getters]
+
+        return parse
+
+    def make_key_getters(self):
+        """
+        Возвращает для каждой группировки функцию, собирающую её ключ из кортежа значений полей в порядке self.fields
+        :return list:
+        """
+
+        key_getters = []
+        for grouping in self.groupings:
+            indexes = [self.fields.index(field) for field in grouping]
+            if len(indexes) == 1:
+                key_getters.append(lambda values, index=indexes[0]: (values[index],))
+            else:
+                key_getters.append(operator.itemgetter(*indexes))
+        return key_getters
+
+    def bucket_label(self, minute_of_day):
+        """
+        Возвращает метку интервала времени суток вида "ЧЧ:ММ", в который попадает минута minute_of_day
+        :param int minute_of_day:
+        :return str:
+        """
+
+        start = minute_of_day // self.time_bucket * self.time_bucket
+        return "{:02d}:{:02d}".format(start // 60, start % 60)
+
+
+def get_dimensions(cfg):
+    """
+    Возвращает группировки для дополнительных таблиц отчёта согласно конфигу или None, если они не заданы
+    :param dict cfg:
+    :return Dimensions:
+    """
+
+    if cfg["REPORT_DIMENSIONS"]:
+        return Dimensions(cfg["REPORT_DIMENSIONS"], cfg["REPORT_TIME_BUCKET"])
+
+
+def get_accumulator_factory(cfg):
+    """
+    Возвращает фабрику накопителей статистики url согласно режиму агрегации из конфига:
+    exact - точный подсчёт, sketch - ограниченная память и приближённая медиана
+    :param dict cfg:
+    :return:
+    """
+
+    if cfg["AGGREGATION"] == "exact":
+        return ExactAccumulator
+    if cfg["AGGREGATION"] == "sketch":
+        mapping = SketchMapping(cfg["SKETCH_RELATIVE_ACCURACY"], cfg["SKETCH_MAX_BUCKETS"])
+        return functools.partial(SketchAccumulator, mapping)
+    raise ValueError("Неизвестный режим агрегации: {}".format(cfg["AGGREGATION"]))
+
+
+report_columns = ("count", "time_avg", "time_max", "time_sum", "time_med", "time_perc", "count_perc")
+
+
+def iter_report_rows(top_urls, report_dict):
+    """
+    Функция - генератор. Возвращает строки отчёта в порядке top_urls согласно представленному ниже шаблону.
+    Дополнительные колонки словаря-отчёта (например, перцентили time_p95) добавляются в конец строки
+    :param list top_urls:
+    :param dict report_dict:
+    """
+
+    for url in top_urls:
+        statistic = report_dict[url]
+        row = {
+            "url": url,
+            "count": statistic["count"],
+            "time_avg": statistic["time_avg"],
+            "time_max": statistic["time_max"],
+            "time_sum": statistic["time_sum"],
+            "time_med": statistic["time_med"],
+            "time_perc": statistic["time_perc"],
+            "count_perc": statistic["count_perc"]
+        }
+        for column in statistic:
+            if column not in report_columns:
+                row[column] = statistic[column]
+        yield row
+
+
+def iter_json_array(rows):
+    """
+    Функция - генератор. Сериализует строки отчёта в JSON-массив по одной строке за раз, не собирая весь JSON в памяти
+    :param rows:
+    """
+
+    yield "["
+    separator = ""
+    for row in rows:
+        yield separator + json.dumps(row)
+        separator = ", "
+    yield "]"
+
+
+def iter_report_json(top_urls, report_dict):
+    """
+    Сериализует словарь-отчёт в JSON-массив по частям. Склеенные части совпадают с результатом serialize_report_dict
+    :param list top_urls:
+    :param dict report_dict:
+    :return:
+    """
+
+    return iter_json_array(iter_report_rows(top_urls, report_dict))
+
+
+def serialize_report_dict(top_urls, report_dict):
+    """
+    Сериализует полученный словарь-отчёт согласно представленному ниже шаблону
+    :param list top_urls:
+    :param dict report_dict:
+    :return str:
+    """
+
+    return json.dumps(list(iter_report_rows(top_urls, report_dict)))
+
+
+def errors_lower_bound(mismatch_count, lines_count, z):
+    """
+    Возвращает нижнюю границу доверительного интервала Уилсона для доли несовпадений
+    :param int mismatch_count:
+    :param int lines_count:
+    :param float z: квантиль нормального распределения (3 - около 99.7%, 4 - около 99.99%)
+    :return float:
+    """
+
+    if not lines_count:
+        return 0.0
+    share = float(mismatch_count) / lines_count
+    z2 = z * z
+    center = share + z2 / (2 * lines_count)
+    spread = z * math.sqrt(share * (1 - share) / lines_count + z2 / (4.0 * lines_count * lines_count))
+    return max(0.0, (center - spread) / (1 + z2 / lines_count))
+
+
+class ErrorRateMonitor(object):
+    """
+    Непрерывная проверка доли несовпадений во время подсчёта статистики. Если размер лога log_size известен
+    (несжатый лог), обработка прерывается, только когда доля ошибок уже не сможет опуститься до max_errors_percent,
+    даже если весь непрочитанный остаток лога окажется правильными строками: правильная строка занимает
+    не меньше min_line_bytes байт, поэтому оставшихся строк не больше (log_size - прочитанные байты) / min_line_bytes.
+    Так допустимый по итоговой доле лог (в том числе с пачкой ошибок в одном месте) никогда не отбрасывается.
+    Размер сжатого лога после распаковки заранее не известен, поэтому для него (log_size = None) после min_lines
+    строк используется нижняя граница доверительного интервала доли ошибок (см. errors_lower_bound).
+    Куски параллельной обработки складывают свои счётчики в общий массив totals (см. share_error_totals)
+    и проверяют суммарные значения. Проверка выполняется только на каждом check_every-м несовпадении,
+    поэтому правильные строки ничего не стоят
+    """
+
+    def __init__(self, max_errors_percent, log_size, min_line_bytes=10, min_lines=100000, z=4.0, check_every=16):
+        self.max_errors_percent = max_errors_percent
+        self.log_size = log_size
+        self.min_line_bytes = min_line_bytes
+        self.min_lines = min_lines
+        self.z = z
+        self.check_every = check_every
+        # Общий для процессов-обработчиков массив (строки, несовпадения, длина несовпадений) и уже добавленная
+        # в него часть счётчиков своего куска
+        self.totals = None
+        self.reported = (0, 0, 0)
+
+    def __getstate__(self):
+        # Общий массив в задачи не передаётся, процессы пула получают его при создании (см. share_error_totals)
+        state = self.__dict__.copy()
+        state["totals"] = None
+        return state
+
+    def max_lines(self, lines_count, mismatch_count, mismatch_bytes):
+        """
+        Возвращает верхнюю границу количества строк несжатого лога
+        :param int lines_count: прочитано строк
+        :param int mismatch_count: из них несовпадений
+        :param int mismatch_bytes: длина несовпавших строк
+        :return int:
+        """
+
+        read_bytes = mismatch_bytes + (lines_count - mismatch_count) * self.min_line_bytes
+        # Последняя строка может быть без перевода строки
+        return lines_count + max(0, self.log_size - read_bytes) // self.min_line_bytes + 1
+
+    def add_totals(self, lines_count, mismatch_count, mismatch_bytes):
+        """
+        Добавляет прирост счётчиков своего куска в общий массив и возвращает суммарные счётчики всех кусков
+        :return tuple:
+        """
+
+        counters = (lines_count, mismatch_count, mismatch_bytes)
+        with self.totals.get_lock():
+            for index, (value, reported) in enumerate(zip(counters, self.reported)):
+                self.totals[index] += value - reported
+            totals = tuple(int(value) for value in self.totals)
+        self.reported = counters
+        return totals
+
+    def check(self, lines_count, mismatch_count, mismatch_bytes):
+        """
+        Бросает ValueError, если доля несовпадений превысит допустимую при любом остатке лога
+        (для сжатого лога - уверенно превышает допустимую)
+        :param int lines_count:
+        :param int mismatch_count:
+        :param int mismatch_bytes:
+        """
+
+        if self.totals is not None:
+            lines_count, mismatch_count, mismatch_bytes = self.add_totals(lines_count, mismatch_count,
+                                                                          mismatch_bytes)
+        if self.log_size is not None:
+            errors_percent = 100.0 * mismatch_count / self.max_lines(lines_count, mismatch_count, mismatch_bytes)
+        elif lines_count >= self.min_lines:
+            errors_percent = 100 * errors_lower_bound(mismatch_count, lines_count, self.z)
+        else:
+            return
+        if errors_percent > self.max_errors_percent:
+            logging.error(u"Слишком много ошибок при обработке лог-файла: не меньше {:.4f}% уже после {} строк\n"
+                          u" Завершаем работу.".format(errors_percent, lines_count))
+            raise ValueError("Слишком много ошибок при обработке лог-файла.")
+
+
+# Общие счётчики проверки доли ошибок в процессах-обработчиках кусков лога
+shared_error_totals = None
+
+
+def share_error_totals(totals):
+    """
+    Инициализатор процессов пула: сохраняет общий массив счётчиков проверки доли ошибок. Синхронизированные
+    массивы multiprocessing нельзя передать в задачах, только при создании процесса
+    :param multiprocessing.Array totals:
+    """
+
+    global shared_error_totals
+    shared_error_totals = totals
+
+
+def get_error_monitor(cfg, log_size):
+    """
+    Возвращает проверку доли ошибок во время подсчёта или None, если она выключена: для несжатого лога
+    не задан ERRORS_MIN_LINE_BYTES, для сжатого (log_size = None) - ERRORS_GZ_MIN_LINES
+    :param dict cfg:
+    :param int log_size: размер несжатого лога или None
+    :return ErrorRateMonitor:
+    """
+
+    if cfg["ERRORS_MIN_LINE_BYTES"] if log_size is not None else cfg["ERRORS_GZ_MIN_LINES"]:
+        return ErrorRateMonitor(cfg["MAX_ERRORS_PERCENT"], log_size, cfg["ERRORS_MIN_LINE_BYTES"],
+                                cfg["ERRORS_GZ_MIN_LINES"], cfg["ERRORS_Z"])
+
+
+class LineQuarantine(object):
+    """
+    Карантин для строк лога, не подошедших под шаблон: первые max_lines таких строк дописываются в файл path
+    для разбора причин. Файл открывается только при первой такой строке. Процессы-обработчики кусков лога
+    пишут каждый в свой файл не больше своей доли max_lines, после обработки файлы склеиваются (см. join_parts)
+    """
+
+    def __init__(self, path, max_lines=1000):
+        self.path = path
+        self.max_lines = max_lines
+        self.count = 0
+        self.quarantine_file = None
+
+    def add(self, line):
+        if self.count >= self.max_lines or line is None:
+            return
+        if self.quarantine_file is None:
+            self.quarantine_file = open(self.path, 'ab')
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        self.quarantine_file.write(line if line.endswith('\n') else line + '\n')
+        self.count += 1
+
+    def close(self):
+        if self.quarantine_file is not None:
+            self.quarantine_file.close()
+            self.quarantine_file = None
+
+    def join_parts(self, parts):
+        """
+        Дописывает в файл карантина файлы карантинов кусков лога по порядку и удаляет их
+        :param list parts: список LineQuarantine
+        """
+
+        self.close()
+        with open(self.path, 'ab') as quarantine_file:
+            for part in parts:
+                if os.path.exists(part.path):
+                    with open(part.path, 'rb') as part_file:
+                        shutil.copyfileobj(part_file, quarantine_file)
+                    os.remove(part.path)
+        if not os.path.getsize(self.path):
+            os.remove(self.path)
+
+    def __getstate__(self):
+        # Открытый файл в процессы-обработчики не передаём
+        return self.path, self.max_lines, self.count
+
+    def __setstate__(self, state):
+        self.path, self.max_lines, self.count = state
+        self.quarantine_file = None
+
+
+def get_quarantine(cfg, nginx_log):
+    """
+    Возвращает карантин для строк лога в файле QUARANTINE_DIR/<имя лога>.bad. Файл с прошлой обработки
+    этого лога удаляется, чтобы строки не копились между запусками
+    :param dict cfg:
+    :param NginxLog nginx_log:
+    :return LineQuarantine:
+    """
+
+    if not os.path.isdir(cfg["QUARANTINE_DIR"]):
+        os.makedirs(cfg["QUARANTINE_DIR"])
+    path = os.path.join(cfg["QUARANTINE_DIR"], nginx_log.name + ".bad")
+    if os.path.exists(path):
+        os.remove(path)
+    return LineQuarantine(path, cfg["QUARANTINE_MAX_LINES"])
+
+
+def collect_statistic(log_iterator, nginx_regex, accumulator_factory=ExactAccumulator, parser_type="regex",
+                      url_normalizer=None, dimensions=None, error_monitor=None, quarantine=None):
+    """
+    Собирает частичную статистику по строкам лога: количество запросов, несовпадений, суммарное время
+    и накопители времени обработки для каждого url. Частичные статистики разных кусков лога можно объединять
+    функцией merge_statistics.
+    :param log_iterator:
+    :param str nginx_regex:
+    :param accumulator_factory: фабрика накопителей (ExactAccumulator или SketchAccumulator)
+    :param str parser_type: regex или fast (для fast строки лучше передавать байтами, без декодирования)
+    :param UrlNormalizer url_normalizer: нормализатор url или None
+    :param Dimensions dimensions: группировки для дополнительных таблиц или None. Если заданы, то строки
+                                  разбираются регулярным выражением группировок, а nginx_regex и parser_type
+                                  не используются
+    :param ErrorRateMonitor error_monitor: проверка доли ошибок во время подсчёта или None
+    :param LineQuarantine quarantine: карантин для строк, не подошедших под шаблон, или None
+    :return PartialStatistic:
+    """
+
+    if dimensions is None:
+        # Парсер для извлечения url и времени обработки
+        parse = line_parsers[parser_type](nginx_regex)
+        groups = None
+    else:
+        parse = dimensions.make_parser()
+        # Для каждой группировки словарь вида {(значения полей..., url): accumulator}
+        groups = [{} for _ in dimensions.groupings]
+    # Суммарное количество запросов
+    all_requests_count = 0
+    # Суммарное время обработки запросов
+    all_requests_time = 0
+    # Суммарное количество несовпадений строки лога шаблону
+    mismatch_count = 0
+    # Суммарная длина несовпавших строк, нужна для проверки доли ошибок
+    mismatch_bytes = 0
+    # Словарь для хранения url и накопителя времени обработки запросов.
+    # Вида {"url1": accumulator1, "urlN": accumulatorN}
+    urls_vs_processing_time = defaultdict(accumulator_factory)
+
+    # Основной цикл обработки лога
+    for line in log_iterator:
+        # Ищем совпадение по шаблону
+        parsed = parse(line)
+        # Даже если совпадения не найдено, то верим в то что каждая строчка лога - это один запрос
+        all_requests_count += 1
+        if parsed:
+            if groups is None:
+                url, request_time = parsed
+            else:
+                url, request_time, group_keys = parsed
+            if url_normalizer is not None:
+                url = url_normalizer(url)
+            request_time = float(request_time)
+            urls_vs_processing_time[url].add(request_time)
+            all_requests_time += request_time
+            if groups is not None:
+                for group, group_key in zip(groups, group_keys):
+                    group_key += (url,)
+                    accumulator = group.get(group_key)
+                    if accumulator is None:
+                        accumulator = group[group_key] = accumulator_factory()
+                    accumulator.add(request_time)
+        else:
+            mismatch_count += 1
+            if quarantine is not None:
+                quarantine.add(line)
+            if error_monitor is not None:
+                mismatch_bytes += len(line)
+                if mismatch_count % error_monitor.check_every == 0:
+                    error_monitor.check(all_requests_count, mismatch_count, mismatch_bytes)
+
+    return PartialStatistic(all_requests_count, all_requests_time, mismatch_count, dict(urls_vs_processing_time),
+                            groups)
+
+
+def merge_accumulators(merged, accumulators):
+    """
+    Добавляет накопители словаря accumulators к накопителям словаря merged с теми же ключами
+    :param dict merged:
+    :param dict accumulators:
+    """
+
+    for key, accumulator in accumulators.iteritems():
+        current = merged.get(key)
+        if current is None:
+            merged[key] = accumulator
+        else:
+            current.merge(accumulator)
+
+
+def merge_statistics(partials):
+    """
+    Объединяет частичные статистики (например, посчитанные разными процессами) в одну
+    :param list partials:
+    :return PartialStatistic:
+    """
+
+    all_requests_count = 0
+    all_requests_time = 0
+    mismatch_count = 0
+    urls_vs_processing_time = {}
+    groups = None
+
+    for partial in partials:
+        all_requests_count += partial.requests_count
+        all_requests_time += partial.requests_time
+        mismatch_count += partial.mismatch_count
+        merge_accumulators(urls_vs_processing_time, partial.urls)
+        if partial.groups is not None:
+            if groups is None:
+                groups = [{} for _ in partial.groups]
+            for merged_group, group in zip(groups, partial.groups):
+                merge_accumulators(merged_group, group)
+
+    return PartialStatistic(all_requests_count, all_requests_time, mismatch_count, urls_vs_processing_time, groups)
+
+
+def fill_statistic(statistic, accumulator, all_requests_count, all_requests_time, percentiles=()):
+    """
+    Заполняет словарь statistic итоговой статистикой накопителя: количество, суммарное, среднее, максимальное
+    и медианное время, проценты от всех запросов и перцентили (колонки вида time_p95)
+    :param dict statistic:
+    :param accumulator:
+    :param int all_requests_count:
+    :param float all_requests_time:
+    :param list percentiles: перцентили в процентах, например [95, 99]
+    """
+
+    count, time_sum, time_max, time_med = accumulator.summary()
+    # count ‐ сколько раз встречается URL, абсолютное значение
+    statistic["count"] = count
+    # time_sum ‐ суммарный $request_time для данного URL'а, абсолютное значение
+    statistic["time_sum"] = time_sum
+    # count_perc ‐ сколько раз встречается URL, в процентнах относительно общего числа запросов
+    statistic["count_perc"] = 100.0 * count / all_requests_count
+    # time_perc ‐ суммарный $request_time для данного URL'а, в процентах относительно общего $request_time всех
+    # запросов
+    statistic["time_perc"] = time_sum / all_requests_time * 100
+    # time_avg ‐ средний $request_time для данного URL'а
+    statistic["time_avg"] = time_sum / count
+    # time_max ‐ максимальный $request_time для данного URL'а
+    statistic["time_max"] = time_max
+    # time_med ‐ медиана $request_time для данного URL'а
+    statistic["time_med"] = time_med
+    if percentiles:
+        for percentile, value in zip(percentiles, accumulator.quantiles([p / 100.0 for p in percentiles])):
+            statistic["time_p{:g}".format(percentile)] = value
+
+
+def finalize_statistic(partial, report_size, max_errors_percent, percentiles=()):
+    """
+    Проверяет долю ошибок и считает итоговую статистику по частичной. Возвращает топ адресов, отсортированных
+    по суммарному времени обработки, и словарь со статистикой по ним. Сначала по дешёвому time_sum накопителей
+    выбираются report_size адресов, и только для них считаются медиана, перцентили и проценты
+    :param PartialStatistic partial:
+    :param int report_size:
+    :param float max_errors_percent:
+    :param list percentiles: перцентили в процентах, например [95, 99]
+    :return tuple:
+    """
+
+    all_requests_count = partial.requests_count
+    all_requests_time = partial.requests_time
+
+    errors_count = 100.0 * partial.mismatch_count / all_requests_count
+    if errors_count > max_errors_percent:
+        logging.error(u"Слишком много ошибок при обработке лог-файла: {:.4f}%\n Завершаем работу.".format(errors_count))
+        raise ValueError("Слишком много ошибок при обработке лог-файла.")
+
+    # Частичный отбор через кучу, без сортировки всех адресов
+    top_items = heapq.nlargest(report_size, partial.urls.iteritems(), key=lambda item: item[1].time_sum)
+
+    top_urls = []
+    report = defaultdict(lambda: defaultdict(float))
+    for url, accumulator in top_items:
+        # Быстрый парсер оставляет url байтами - декодируем только при формировании отчёта
+        if isinstance(url, str):
+            url = url.decode('utf-8')
+        fill_statistic(report[url], accumulator, all_requests_count, all_requests_time, percentiles)
+        top_urls.append(url)
+
+    return top_urls, report
+
+
+def finalize_groups(partial, dimensions, report_size, percentiles=()):
+    """
+    Считает итоговую статистику по группировкам частичной статистики. Для каждой группировки возвращает
+    список строк дополнительной таблицы отчёта: значения полей группировки, url и статистика, не больше
+    report_size строк с наибольшим суммарным временем обработки. Проценты считаются от всех запросов лога
+    :param PartialStatistic partial:
+    :param Dimensions dimensions:
+    :param int report_size:
+    :param list percentiles:
+    :return list:
+    """
+
+    tables = []
+    for grouping, group in zip(dimensions.groupings, partial.groups or []):
+        rows = []
+        for group_key, accumulator in heapq.nlargest(report_size, group.iteritems(),
+                                                     key=lambda item: item[1].time_sum):
+            row = dict(zip(grouping, group_key[:-1]))
+            url = group_key[-1]
+            row["url"] = url.decode('utf-8') if isinstance(url, str) else url
+            fill_statistic(row, accumulator, partial.requests_count, partial.requests_time, percentiles)
+            rows.append(row)
+        tables.append(rows)
+    return tables
+
+
+def calculate_statistic(log_iterator, nginx_regex, report_size, max_errors_percent,
+                        accumulator_factory=ExactAccumulator, parser_type="regex", url_normalizer=None,
+                        percentiles=(), dimensions=None):
+    """
+    Считает статистику по лог файлу. Возвращает словарь со всеми данными и топ адресов, отсортированных
+    по количеству вхождений. Если заданы группировки, то за тот же проход считаются и их таблицы,
+    которые возвращаются третьим элементом (см. finalize_groups)
+    :param log_iterator:
+    :param str nginx_regex:
+    :param int report_size:
+    :param float max_errors_percent:
+    :param accumulator_factory:
+    :param str parser_type:
+    :param UrlNormalizer url_normalizer:
+    :param list percentiles: перцентили в процентах, например [95, 99]
+    :param Dimensions dimensions:
+    :return tuple:
+    """
+
+    partial = collect_statistic(log_iterator, nginx_regex, accumulator_factory, parser_type, url_normalizer,
+                                dimensions)
+    top_urls, report = finalize_statistic(partial, report_size, max_errors_percent, percentiles)
+    if dimensions is None:
+        return top_urls, report
+    return top_urls, report, finalize_groups(partial, dimensions, report_size, percentiles)
+
+
+def split_log_chunks(log_full_name, chunks_count):
+    """
+    Делит несжатый лог-файл на chunks_count кусков по байтовым смещениям, выровненным по границам строк.
+    Возвращает список пар (начало, конец)
+    :param str log_full_name:
+    :param int chunks_count:
+    :return list:
+    """
+
+    file_size = os.path.getsize(log_full_name)
+    boundaries = [0]
+    with io.open(log_full_name, mode='rb') as log_file:
+        for i in xrange(1, chunks_count):
+            offset = file_size * i // chunks_count
+            if offset <= boundaries[-1]:
+                continue
+            # Дочитываем строку до конца, чтобы кусок начинался с начала строки
+            log_file.seek(offset - 1)
+            log_file.readline()
+            offset = log_file.tell()
+            if boundaries[-1] < offset < file_size:
+                boundaries.append(offset)
+    boundaries.append(file_size)
+
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+
+def read_log_chunk(log_full_name, start, end, decode=True, plain_reader="io", block_size=1 << 20):
+    """
+    Функция - генератор. Итерируется построчно по куску несжатого лог-файла между смещениями start и end
+    :param str log_full_name:
+    :param int start:
+    :param int end:
+    :param bool decode:
+    :param str plain_reader: io или mmap (строки возвращаются без перевода строки)
+    :param int block_size:
+    """
+
+    if plain_reader == "mmap":
+        for line in split_blocks(read_mmap_blocks(log_full_name, block_size, start, end)):
+            yield line.decode('utf-8') if decode else line
+        return
+
+    with io.open(log_full_name, mode='rb') as log_file:
+        log_file.seek(start)
+        position = start
+        while position < end:
+            line = log_file.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode('utf-8') if decode else line
+
+
+def sample_log_lines(log_full_name, file_type, lines_count, spans=16, decode=True):
+    """
+    Возвращает выборку примерно из lines_count строк лога. Из несжатого лога строки читаются подряд в spans местах,
+    равномерно распределённых по файлу (переходом по смещениям), из сжатого - с начала файла
+    :param str log_full_name:
+    :param str file_type:
+    :param int lines_count:
+    :param int spans:
+    :param bool decode:
+    :return list:
+    """
+
+    if file_type == '.gz':
+        return list(itertools.islice(read_log(log_full_name, file_type, decode=decode), lines_count))
+
+    chunks = split_log_chunks(log_full_name, spans)
+    span_lines = max(1, lines_count // max(len(chunks), 1))
+    sample = []
+    for start, end in chunks:
+        sample.extend(itertools.islice(read_log_chunk(log_full_name, start, end, decode=decode), span_lines))
+    return sample
+
+
+def preflight_log(log_full_name, file_type, nginx_regex, parser_type, lines_count, max_errors_percent, z=4.0,
+                  dimensions=None):
+    """
+    Проверяет формат лога по выборке строк до полного прохода. Бросает ValueError, если нижняя граница
+    доверительного интервала доли несовпадений в выборке превышает max_errors_percent
+    :param str log_full_name:
+    :param str file_type:
+    :param str nginx_regex:
+    :param str parser_type:
+    :param int lines_count: размер выборки
+    :param float max_errors_percent:
+    :param float z:
+    :param Dimensions dimensions:
+    :return float: доля несовпадений в выборке, в процентах
+    """
+
+    sample = sample_log_lines(log_full_name, file_type, lines_count, decode=parser_type == "regex")
+    partial = collect_statistic(iter(sample), nginx_regex, ExactAccumulator, parser_type, dimensions=dimensions)
+    errors_percent = 100.0 * partial.mismatch_count / partial.requests_count if partial.requests_count else 0.0
+    logging.info(u"Проверка формата лога по выборке из {} строк: {:.2f}% несовпадений".format(partial.requests_count,
+                                                                                          errors_percent))
+    if 100 * errors_lower_bound(partial.mismatch_count, partial.requests_count, z) > max_errors_percent:
+        logging.error(u"Лог {} не подходит под формат: {:.2f}% несовпадений в выборке из {} строк\n"
+                      u" Завершаем работу.".format(log_full_name, errors_percent, partial.requests_count))
+        raise ValueError("Слишком много ошибок при обработке лог-файла.")
+    return errors_percent
+
+
+def collect_chunk_statistic(task):
+    """
+    Функция для процессов-обработчиков: собирает частичную статистику по одному куску лога
+    :param tuple task: (имя лога, начало куска, конец куска, регулярное выражение, фабрика накопителей, парсер,
+                        способ чтения, нормализатор url, группировки, проверка доли ошибок, карантин)
+    :return PartialStatistic:
+    """
+
+    (log_full_name, start, end, nginx_regex, accumulator_factory, parser_type, plain_reader, url_normalizer,
+     dimensions, error_monitor, quarantine) = task
+    if error_monitor is not None:
+        error_monitor.totals = shared_error_totals
+    log_iterator = read_log_chunk(log_full_name, start, end, decode=parser_type == "regex", plain_reader=plain_reader)
+    try:
+        return collect_statistic(log_iterator, nginx_regex, accumulator_factory, parser_type, url_normalizer,
+                                 dimensions, error_monitor, quarantine)
+    finally:
+        # Процессы пула завершаются без сброса буферов файлов
+        if quarantine is not None:
+            quarantine.close()
+
+
+def collect_statistic_parallel(log_full_name, nginx_regex, workers, accumulator_factory=ExactAccumulator,
+                               parser_type="regex", plain_reader="io", url_normalizer=None, dimensions=None,
+                               error_monitor=None, quarantine=None):
+    """
+    Собирает частичную статистику по несжатому лог файлу в workers процессах. Каждый процесс обрабатывает
+    свой кусок файла, частичные статистики объединяются по мере готовности кусков
+    :param str log_full_name:
+    :param str nginx_regex:
+    :param int workers:
+    :param accumulator_factory:
+    :param str parser_type:
+    :param str plain_reader:
+    :param UrlNormalizer url_normalizer:
+    :param Dimensions dimensions:
+    :param ErrorRateMonitor error_monitor:
+    :param LineQuarantine quarantine:
+    :return PartialStatistic:
+    """
+
+    chunks = split_log_chunks(log_full_name, workers)
+    chunk_quarantines = [None] * len(chunks)
+    if quarantine is not None:
+        # Буферы файлов разных процессов могут сбрасываться посреди строки, поэтому каждый кусок пишет свою долю
+        # строк карантина в отдельный файл <карантин>.<начало куска>
+        share = max(1, quarantine.max_lines // max(len(chunks), 1))
+        chunk_quarantines = [LineQuarantine("{}.{}".format(quarantine.path, start), share) for start, _ in chunks]
+    tasks = [(log_full_name, start, end, nginx_regex, accumulator_factory, parser_type, plain_reader, url_normalizer,
+              dimensions, error_monitor, chunk_quarantine)
+             for (start, end), chunk_quarantine in zip(chunks, chunk_quarantines)]
+    logging.info(u"Обрабатываем лог в {} процессах, кусков: {}".format(workers, len(tasks)))
+
+    # Проверка доли ошибок ведётся по суммарным счётчикам всех кусков, а не по каждому куску отдельно
+    pool = multiprocessing.Pool(processes=workers, initializer=share_error_totals,
+                                initargs=(multiprocessing.Array('d', 3) if error_monitor is not None else None,))
+    partial = merge_statistics([])
+    try:
+        # Объединяем статистики кусков по мере готовности, не держа в памяти статистики всех кусков сразу
+        for chunk_partial in pool.imap_unordered(collect_chunk_statistic, tasks):
+            partial = merge_statistics([partial, chunk_partial])
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if quarantine is not None:
+            quarantine.join_parts(chunk_quarantines)
+
+    return partial
+
+
+def calculate_statistic_parallel(log_full_name, nginx_regex, report_size, max_errors_percent, workers,
+                                 accumulator_factory=ExactAccumulator, parser_type="regex", plain_reader="io",
+                                 url_normalizer=None):
+    """
+    Считает статистику по несжатому лог файлу в workers процессах. Результат такой же, как у calculate_statistic
+    :param str log_full_name:
+    :param str nginx_regex:
+    :param int report_size:
+    :param float max_errors_percent:
+    :param int workers:
+    :param accumulator_factory:
+    :param str parser_type:
+    :param str plain_reader:
+    :param UrlNormalizer url_normalizer:
+    :return tuple:
+    """
+
+    partial = collect_statistic_parallel(log_full_name, nginx_regex, workers, accumulator_factory, parser_type,
+                                         plain_reader, url_normalizer)
+    return finalize_statistic(partial, report_size, max_errors_percent)
+
+
+class AggregateCache(object):
+    """
+    Хранилище частичных статистик уже обработанных логов в файле SQLite.
+    Запись ищется по имени лога и считается актуальной, только если совпадают размер файла,
+    время его изменения и режим агрегации.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS aggregates ("
+                                "log_name TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                                "aggregation TEXT, partial BLOB)")
+        self.connection.commit()
+
+    def get(self, log_name, size, mtime, aggregation):
+        """
+        Возвращает сохранённую частичную статистику или None, если её нет или лог изменился
+        :param str log_name:
+        :param int size:
+        :param float mtime:
+        :param str aggregation:
+        :return PartialStatistic:
+        """
+
+        row = self.connection.execute("SELECT size, mtime, aggregation, partial FROM aggregates WHERE log_name = ?",
+                                      (log_name,)).fetchone()
+        if row is None or (row[0], row[1], row[2]) != (size, mtime, aggregation):
+            return
+        return PartialStatistic(*cPickle.loads(zlib.decompress(row[3])))
+
+    def put(self, log_name, size, mtime, aggregation, partial):
+        """
+        Сохраняет частичную статистику лога, заменяя прежнюю запись
+        :param str log_name:
+        :param int size:
+        :param float mtime:
+        :param str aggregation:
+        :param PartialStatistic partial:
+        """
+
+        blob = zlib.compress(cPickle.dumps(tuple(partial), cPickle.HIGHEST_PROTOCOL))
+        self.connection.execute("INSERT OR REPLACE INTO aggregates VALUES (?, ?, ?, ?, ?)",
+                                (log_name, size, mtime, aggregation, sqlite3.Binary(blob)))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+# Версия колоночного формата: при несовпадении колонки считаются устаревшими
+COLUMNS_VERSION = 1
+# Колонки разобранного лога и их типы. Время обработки хранится целыми миллисекундами (разрешение $request_time),
+# поэтому 4 байт хватает, а итоговые суммы совпадают с разбором текстового лога
+log_columns = (
+    ("url_ids", "uint32"),
+    ("times_ms", "uint32"),
+    ("statuses", "uint16"),
+    ("method_ids", "uint8"),
+    ("timestamps", "uint32"),
+)
+column_typecodes = {
+    "uint8": 'B',
+    "uint16": 'H',
+    "uint32": 'I' if array('I').itemsize == 4 else 'L',
+}
+months = dict((month, number) for number, month in enumerate(
+    ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"), 1))
+
+
+def get_columns_dir(cfg, nginx_log):
+    """
+    Возвращает папку с колоночной копией лога или None, если COLUMNS_DIR не задан
+    :param dict cfg:
+    :param NginxLog nginx_log:
+    :return str:
+    """
+
+    if cfg["COLUMNS_DIR"]:
+        return os.path.join(cfg["COLUMNS_DIR"], nginx_log.name)
+
+
+def load_columns_meta(columns_dir, log_stat=None):
+    """
+    Возвращает описание колоночной копии лога или None, если её нет, формат устарел
+    или (при заданном log_stat) лог изменился после преобразования
+    :param str columns_dir:
+    :param log_stat: результат os.stat исходного лога
+    :return dict:
+    """
+
     try:
-        recent_log = logs_names_gen.next()
-    except StopIteration:
+        with open(os.path.join(columns_dir, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+    except IOError:
         return
-
-    recent_date = recent_log[1]
-
-    for cur_log_name, cur_date, cur_log_ext in logs_names_gen:
-                if recent_date < cur_date:
-                    recent_date = cur_date
-                    recent_log = cur_log_name, cur_date, cur_log_ext
-
-    # Возвращаем имя лога, дату создания, расширение файла
-    return NginxLog(*recent_log)
+    if meta["version"] != COLUMNS_VERSION:
+        return
+    if log_stat is not None and (meta["size"], meta["mtime"]) != (log_stat.st_size, log_stat.st_mtime):
+        return
+    return meta
 
 
-def read_log(log_full_name, file_type):
+def convert_log(log_full_name, file_type, columns_dir, gzip_reader="gzip", block_size=1 << 20, plain_reader="io",
+                chunk_rows=1 << 16):
     """
-    Функция - генератор. Итерируется по лог-файлу построчно
+    Разбирает лог один раз и сохраняет его в колоночном формате в папку columns_dir: по файлу на колонку
+    (массивы array в машинном порядке байт, дописываются кусками по chunk_rows строк), словари url и методов
+    и meta.json с размером и временем изменения лога, количеством строк и несовпадений.
+    url кодируются номером в словаре urls.txt, время обработки - целыми миллисекундами, время запроса -
+    секундами местного времени из $time_local (смещение часового пояса первой строки сохраняется в meta.json).
+    Папка заменяется целиком только после успешной записи
     :param str log_full_name:
     :param str file_type:
+    :param str columns_dir:
+    :param str gzip_reader:
+    :param int block_size:
+    :param str plain_reader:
+    :param int chunk_rows:
+    :return dict: описание колоночной копии
     """
 
-    f_open = gzip.open if file_type == '.gz' else io.open
+    log_stat = os.stat(log_full_name)
+    search = re.compile(regexprs["NGINX_DIMENSIONS_REGEXP"]).search
+    temp_dir = columns_dir + ".tmp"
+    if os.path.isdir(temp_dir):
+        shutil.rmtree(temp_dir)
+    os.makedirs(temp_dir)
+
+    url_ids = {}
+    urls = []
+    method_ids = {}
+    methods = []
+    # Полночь каждой даты из $time_local в секундах, дат в логе единицы
+    day_starts = {}
+    columns = dict((name, array(column_typecodes[column_type])) for name, column_type in log_columns)
+    column_files = dict((name, open(os.path.join(temp_dir, name + ".bin"), 'wb')) for name, _ in log_columns)
+    lines = rows = mismatches = 0
+    utc_offset = None
+    max_time_ms = (1 << 32) - 1
+
     try:
-        with f_open(log_full_name, mode='r') as log_file:
-            for line in log_file:
-                yield line.decode('utf-8')  # Так универсальнее
-    except IOError as error:
-        logging.error(u"Проблема с чтением из лог файла: {}".format(error))
-        yield None
+        for line in read_log(log_full_name, file_type, decode=False, gzip_reader=gzip_reader, block_size=block_size,
+                             plain_reader=plain_reader):
+            lines += 1
+            match = search(line) if line is not None else None
+            if match is None:
+                mismatches += 1
+                continue
+            url, request_time, method, status, time_local = match.group("url", "time", "method", "status",
+                                                                         "time_local")
+            try:
+                time_ms = min(int(round(float(request_time) * 1000)), max_time_ms)
+                day_start = day_starts.get(time_local[:11])
+                if day_start is None:
+                    # $time_local вида 29/Jun/2017:03:50:22 +0300
+                    day_start = day_starts[time_local[:11]] = calendar.timegm(
+                        (int(time_local[7:11]), months[time_local[3:6]], int(time_local[:2]), 0, 0, 0))
+                timestamp = (day_start + int(time_local[12:14]) * 3600 + int(time_local[15:17]) * 60 +
+                             int(time_local[18:20]))
+            except (ValueError, KeyError):
+                mismatches += 1
+                continue
+            if utc_offset is None:
+                utc_offset = time_local[21:]
+
+            url_id = url_ids.get(url)
+            if url_id is None:
+                url_id = url_ids[url] = len(urls)
+                urls.append(url)
+            method_id = method_ids.get(method)
+            if method_id is None:
+                method_id = method_ids[method] = len(methods)
+                methods.append(method)
+
+            columns["url_ids"].append(url_id)
+            columns["times_ms"].append(time_ms)
+            columns["statuses"].append(int(status))
+            columns["method_ids"].append(method_id)
+            columns["timestamps"].append(timestamp)
+            rows += 1
+            if rows % chunk_rows == 0:
+                for name, column in columns.iteritems():
+                    column.tofile(column_files[name])
+                    del column[:]
+
+        for name, column in columns.iteritems():
+            column.tofile(column_files[name])
+    finally:
+        for column_file in column_files.itervalues():
+            column_file.close()
+
+    # url без пробельных символов (группа \S+), поэтому словарь хранится построчно без экранирования
+    with open(os.path.join(temp_dir, "urls.txt"), 'wb') as urls_file:
+        for url in urls:
+            urls_file.write(url + "\n")
+    meta = {
+        "version": COLUMNS_VERSION,
+        "log": os.path.basename(log_full_name),
+        "size": log_stat.st_size,
+        "mtime": log_stat.st_mtime,
+        "lines": lines,
+        "rows": rows,
+        "mismatches": mismatches,
+        "methods": methods,
+        "utc_offset": utc_offset,
+        "byteorder": sys.byteorder,
+        "columns": dict(log_columns),
+    }
+    with open(os.path.join(temp_dir, "meta.json"), 'w') as meta_file:
+        json.dump(meta, meta_file, indent=2)
 
+    if os.path.isdir(columns_dir):
+        shutil.rmtree(columns_dir)
+    os.rename(temp_dir, columns_dir)
+    logging.info(u"Лог {} сохранён в колоночном формате: {} строк, {} url".format(log_full_name, rows, len(urls)))
+    return meta
 
-def median(lst):
+
+def iter_columns(columns_dir, names, meta=None, chunk_rows=1 << 16):
     """
-    Возвращает медиану !отсортированного! списка
-    :param list lst:
-    :return float:
+    Читает колонки names колоночной копии лога кусками по chunk_rows строк (array.fromfile, без разбора строк),
+    чтобы в памяти не держать колонки целиком
+    :param str columns_dir:
+    :param list names:
+    :param dict meta: описание колоночной копии, если уже загружено
+    :param int chunk_rows:
+    :return: генератор {имя колонки: array} с одинаковым количеством строк в каждой колонке
     """
 
-    n = len(lst)
-    if n < 1:
-            return None
-    if n % 2 == 1:
-            return lst[n//2]
-    else:
-            return sum(lst[n//2-1:n//2+1])/2.0
+    meta = meta or load_columns_meta(columns_dir)
+    column_files = dict((name, open(os.path.join(columns_dir, name + ".bin"), 'rb')) for name in names)
+    try:
+        for start in xrange(0, meta["rows"], chunk_rows):
+            columns = {}
+            for name in names:
+                column = array(column_typecodes[meta["columns"][name]])
+                column.fromfile(column_files[name], min(chunk_rows, meta["rows"] - start))
+                if meta["byteorder"] != sys.byteorder:
+                    column.byteswap()
+                columns[name] = column
+            yield columns
+    finally:
+        for column_file in column_files.itervalues():
+            column_file.close()
+
+
+def collect_statistic_columns(columns_dir, accumulator_factory=ExactAccumulator, url_normalizer=None,
+                              dimensions=None, meta=None, decode=False, chunk_rows=1 << 16):
+    """
+    Собирает частичную статистику по колоночной копии лога. Результат такой же, как у collect_statistic
+    по исходному логу, но строки не читаются и не разбираются: url нормализуются один раз для каждого
+    значения словаря, а цикл идёт по числовым массивам. Читаются только нужные колонки, кусками по chunk_rows строк
+    :param str columns_dir:
+    :param accumulator_factory:
+    :param UrlNormalizer url_normalizer:
+    :param Dimensions dimensions:
+    :param dict meta: описание колоночной копии, если уже загружено
+    :param bool decode: декодировать url словаря, как разбор декодированных строк лога (PARSER = regex)
+    :param int chunk_rows:
+    :return PartialStatistic:
+    """
 
+    meta = meta or load_columns_meta(columns_dir)
+    names = ["url_ids", "times_ms"]
+    if dimensions is not None:
+        names += ["statuses", "method_ids", "timestamps"]
+    with open(os.path.join(columns_dir, "urls.txt"), 'rb') as urls_file:
+        urls = [url.rstrip("\n") for url in urls_file]
+    # Иначе ключи url не совпадут со статистикой, посчитанной по исходным логам, и при объединении задвоятся
+    if decode:
+        urls = [url.decode('utf-8') for url in urls]
+
+    # Накопитель для каждого номера url, одинаковые после нормализации url делят один накопитель
+    urls_vs_processing_time = {}
+    url_keys = []
+    url_accumulators = []
+    for url in urls:
+        key = url_normalizer(url) if url_normalizer is not None else url
+        accumulator = urls_vs_processing_time.get(key)
+        if accumulator is None:
+            accumulator = urls_vs_processing_time[key] = accumulator_factory()
+        url_keys.append(key)
+        url_accumulators.append(accumulator)
+
+    groups = None
+    if dimensions is not None:
+        groups = [{} for _ in dimensions.groupings]
+        key_getters = dimensions.make_key_getters()
+        methods = [str(method) for method in meta["methods"]]
+        bucket_labels = [dimensions.bucket_label(minute) for minute in xrange(24 * 60)]
+        status_values = {}
 
-def serialize_report_dict(top_urls, report_dict):
+    all_requests_time = 0
+    for columns in iter_columns(columns_dir, names, meta, chunk_rows):
+        for url_id, time_ms in itertools.izip(columns["url_ids"], columns["times_ms"]):
+            request_time = time_ms / 1000.0
+            url_accumulators[url_id].add(request_time)
+            all_requests_time += request_time
+
+        if dimensions is None:
+            continue
+        for url_id, time_ms, status, method_id, timestamp in itertools.izip(
+                columns["url_ids"], columns["times_ms"], columns["statuses"], columns["method_ids"],
+                columns["timestamps"]):
+            status_value = status_values.get(status)
+            if status_value is None:
+                status_value = status_values[status] = (str(status), str(status)[0] + "xx")
+            values = status_value + (methods[method_id], bucket_labels[timestamp % 86400 // 60])
+            url = url_keys[url_id]
+            request_time = time_ms / 1000.0
+            for group, key_getter in zip(groups, key_getters):
+                group_key = key_getter(values) + (url,)
+                accumulator = group.get(group_key)
+                if accumulator is None:
+                    accumulator = group[group_key] = accumulator_factory()
+                accumulator.add(request_time)
+
+    return PartialStatistic(meta["lines"], all_requests_time, meta["mismatches"], urls_vs_processing_time, groups)
+
+
+def convert_logs(cfg):
     """
-    Сериализует полученный словарь-отчёт согласно представленному ниже шаблону
-    :param list top_urls:
-    :param dict report_dict:
-    :return str:
+    Режим преобразования: сохраняет в колоночном формате в COLUMNS_DIR все логи из LOG_DIR,
+    у которых ещё нет актуальной колоночной копии
+    :param dict cfg:
+    :return list: имена преобразованных логов
+    """
+
+    init_logging(cfg)
+    if not prepare_run(cfg):
+        return
+    if not cfg["COLUMNS_DIR"]:
+        logging.error(u"Не задана папка для колоночных копий логов COLUMNS_DIR. Завершаем работу.")
+        return
+    if not os.path.isdir(cfg["COLUMNS_DIR"]):
+        os.makedirs(cfg["COLUMNS_DIR"])
+
+    converted = []
+    logs = get_logs_by_date(cfg["LOG_DIR"], regexprs["LOG_NAME_REGEXP"])
+    for raw_date, (log_name, log_ext) in sorted(logs.iteritems()):
+        nginx_log = NginxLog(log_name, parse_log_date(raw_date), log_ext)
+        log_full_name = os.path.join(cfg["LOG_DIR"], log_name)
+        columns_dir = get_columns_dir(cfg, nginx_log)
+        if load_columns_meta(columns_dir, os.stat(log_full_name)) is not None:
+            continue
+        convert_log(log_full_name, log_ext, columns_dir, cfg["GZIP_READER"], cfg["GZIP_BLOCK_SIZE"],
+                    cfg["PLAIN_READER"])
+        converted.append(log_name)
+    logging.info(u"Преобразовано логов: {}".format(len(converted)))
+    return converted
+
+
+class Metrics(object):
+    """
+    Таймеры и счётчики этапов обработки для одного запуска: время по фазам, прочитанные байты, количество строк,
+    несовпадений и различных url, пиковая память. Сохраняются рядом с отчётом в JSON или в текстовом формате
+    Prometheus
     """
 
-    report = []
+    def __init__(self):
+        self.started = time.time()
+        self.timers = defaultdict(float)
+        self.counters = defaultdict(int)
 
-    for url in top_urls:
-        statistic = report_dict[url]
-        report.append(
-            {
-                "url": url,
-                "count": statistic["count"],
-                "time_avg": statistic["time_avg"],
-                "time_max": statistic["time_max"],
-                "time_sum": statistic["time_sum"],
-                "time_med": statistic["time_med"],
-                "time_perc": statistic["time_perc"],
-                "count_perc": statistic["count_perc"]
-            }
-        )
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """
+        Контекстный менеджер, добавляющий время выполнения блока к таймеру фазы phase
+        :param str phase:
+        """
 
-    return json.dumps(report)
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.timers[phase] += time.time() - started
+
+    def timed_iterator(self, iterable, phase):
+        """
+        Функция - генератор. Возвращает элементы iterable, считая время их получения в таймер фазы phase.
+        Позволяет отделить время чтения и распаковки лога от разбора строк
+        :param iterable:
+        :param str phase:
+        """
+
+        iterator = iter(iterable)
+        clock = time.time
+        elapsed = 0.0
+        try:
+            while True:
+                started = clock()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    elapsed += clock() - started
+                    return
+                elapsed += clock() - started
+                yield item
+        finally:
+            self.timers[phase] += elapsed
+
+    def count(self, counter, value=1):
+        self.counters[counter] += value
+
+    def as_dict(self):
+        """
+        Возвращает все метрики словарем
+        :return dict:
+        """
+
+        collect_seconds = self.timers.get("collect", 0.0)
+        return {
+            "seconds": time.time() - self.started,
+            "phases": dict(self.timers),
+            "counters": dict(self.counters),
+            "lines_per_second": self.counters.get("lines", 0) / collect_seconds if collect_seconds else None,
+            # На linux ru_maxrss в килобайтах
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "children_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        }
+
+    def as_prometheus(self):
+        """
+        Возвращает метрики в текстовом формате Prometheus (для node_exporter textfile collector)
+        :return str:
+        """
+
+        metrics = self.as_dict()
+        lines = ["# TYPE log_analyzer_phase_seconds gauge"]
+        for phase, seconds in sorted(metrics["phases"].iteritems()):
+            lines.append('log_analyzer_phase_seconds{{phase="{}"}} {!r}'.format(phase, seconds))
+        for counter, value in sorted(metrics["counters"].iteritems()):
+            lines.append("# TYPE log_analyzer_{}_total counter".format(counter))
+            lines.append("log_analyzer_{}_total {}".format(counter, value))
+        for name in ("seconds", "lines_per_second", "peak_rss_kb", "children_peak_rss_kb"):
+            if metrics[name] is not None:
+                lines.append("# TYPE log_analyzer_{} gauge".format(name))
+                lines.append("log_analyzer_{} {!r}".format(name, metrics[name]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, report_name, metrics_format):
+        """
+        Сохраняет метрики рядом с отчётом report_name: report-*.metrics.json или report-*.prom
+        :param str report_name:
+        :param str metrics_format: json или prometheus
+        :return str: имя файла метрик
+        """
+
+        base_name = os.path.splitext(report_name)[0]
+        if metrics_format == "json":
+            metrics_name, content = base_name + ".metrics.json", json.dumps(self.as_dict(), indent=2, sort_keys=True)
+        elif metrics_format == "prometheus":
+            metrics_name, content = base_name + ".prom", self.as_prometheus()
+        else:
+            raise ValueError("Неизвестный формат метрик: {}".format(metrics_format))
+        # Пишем через временный файл, чтобы сборщик метрик не прочитал его недописанным
+        temp_name = metrics_name + ".tmp"
+        with open(temp_name, 'w') as metrics_file:
+            metrics_file.write(content)
+        os.rename(temp_name, metrics_name)
+        logging.info(u"Метрики сохранены в {}".format(metrics_name))
+        return metrics_name
 
 
-def calculate_statistic(log_iterator, nginx_regex, report_size, max_errors_percent):
+def get_log_statistic(cfg, nginx_log, cache=None, metrics=None):
     """
-    Считает статистику по лог файлу. Возвращает словарь со всеми данными и топ адресов, отсортированных
-    по количеству вхождений
-    :param log_iterator:
-    :param str nginx_regex:
-    :param int report_size:
-    :param float max_errors_percent:
-    :return tuple:
+    Возвращает частичную статистику по логу: из хранилища, если лог уже обрабатывался и не менялся,
+    иначе разбирает лог и сохраняет результат в хранилище
+    :param dict cfg:
+    :param NginxLog nginx_log:
+    :param AggregateCache cache:
+    :param Metrics metrics: метрики запуска или None
+    :return PartialStatistic:
     """
 
-    # Регулярное выражение для извлечения url и времени обработки
-    nginx_pattern = re.compile(nginx_regex)
-    # Суммарное количество запросов
-    all_requests_count = 0
-    # Суммарное время обработки запросов
-    all_requests_time = 0
-    # Суммарное количество несовпадений строки лога шаблону
-    mismatch_count = 0
-    # Словарь для хранения url и списка времени обработки запросов.
-    # Вида {"url1": [time1, time2, ..., timeN], "urlN": [...]}
-    urls_vs_processing_time = defaultdict(list)
-
-    # Основной цикл обработки лога
-    for line in log_iterator:
-        # Ищем совпадение по шаблону
-        match = nginx_pattern.search(line)
-        # Даже если совпадения не найдено, то верим в то что каждая строчка лога - это один запрос
-        all_requests_count += 1
-        if match:
-            request_time = float(match.group("time"))
-            urls_vs_processing_time[match.group("url")].append(request_time)
-            all_requests_time += request_time
+    log_full_name = os.path.join(cfg["LOG_DIR"], nginx_log.name)
+    log_stat = os.stat(log_full_name)
+    url_normalizer = get_url_normalizer(cfg)
+    dimensions = get_dimensions(cfg)
+    # Парсеры по-разному хранят url (unicode или байты), поэтому статистики разных парсеров,
+    # разных настроек нормализации и группировок не смешиваем
+    aggregation = u"{}:{}:{}".format(cfg["AGGREGATION"], cfg["PARSER"], url_normalizer.key if url_normalizer else "")
+    if cfg["AGGREGATION"] == "sketch":
+        aggregation += u":" + SketchMapping(cfg["SKETCH_RELATIVE_ACCURACY"], cfg["SKETCH_MAX_BUCKETS"]).key
+    if dimensions is not None:
+        aggregation += u":" + dimensions.key
+
+    if cache is not None:
+        partial = cache.get(nginx_log.name, log_stat.st_size, log_stat.st_mtime, aggregation)
+        if partial is not None:
+            logging.info(u"Статистика по логу {} взята из хранилища".format(nginx_log.name))
+            if metrics is not None:
+                metrics.count("logs_cached")
+            return partial
+
+    metrics = metrics if metrics is not None else Metrics()
+    accumulator_factory = get_accumulator_factory(cfg)
+    columns_dir = get_columns_dir(cfg, nginx_log)
+    columns_meta = load_columns_meta(columns_dir, log_stat) if columns_dir else None
+    error_monitor = get_error_monitor(cfg, log_stat.st_size if nginx_log.extension != '.gz' else None)
+    quarantine = None
+    if columns_meta is None:
+        if cfg["PREFLIGHT_SAMPLES"]:
+            with metrics.timer("preflight"):
+                preflight_log(log_full_name, nginx_log.extension, regexprs["NGINX_REGEXP"], cfg["PARSER"],
+                              cfg["PREFLIGHT_SAMPLES"], cfg["MAX_ERRORS_PERCENT"], cfg["ERRORS_Z"], dimensions)
+        if cfg["QUARANTINE_DIR"]:
+            quarantine = get_quarantine(cfg, nginx_log)
+    with metrics.timer("collect"):
+        if columns_meta is not None:
+            logging.info(u"Статистика по логу {} считается по колоночной копии".format(nginx_log.name))
+            partial = collect_statistic_columns(columns_dir, accumulator_factory, url_normalizer, dimensions,
+                                                columns_meta, decode=cfg["PARSER"] == "regex")
+            metrics.count("logs_columns")
+        # Параллельно можно обрабатывать только несжатые логи - их можно разбить на куски по смещениям
+        elif cfg["WORKERS"] > 1 and nginx_log.extension != '.gz':
+            partial = collect_statistic_parallel(log_full_name, regexprs["NGINX_REGEXP"], cfg["WORKERS"],
+                                                 accumulator_factory, cfg["PARSER"], cfg["PLAIN_READER"],
+                                                 url_normalizer, dimensions, error_monitor, quarantine)
         else:
-            mismatch_count += 1
+            log_iterator = read_log(log_full_name, nginx_log.extension, decode=cfg["PARSER"] == "regex",
+                                    gzip_reader=cfg["GZIP_READER"], block_size=cfg["GZIP_BLOCK_SIZE"],
+                                    plain_reader=cfg["PLAIN_READER"])
+            # Замер времени каждой строки не бесплатен, поэтому включается только вместе с метриками
+            if cfg["METRICS_FORMAT"]:
+                log_iterator = metrics.timed_iterator(log_iterator, "read")
+            try:
+                partial = collect_statistic(log_iterator, regexprs["NGINX_REGEXP"], accumulator_factory,
+                                            cfg["PARSER"], url_normalizer, dimensions, error_monitor, quarantine)
+            finally:
+                if quarantine is not None:
+                    quarantine.close()
+    metrics.count("logs")
+    metrics.count("bytes_read", log_stat.st_size)
+    metrics.count("lines", partial.requests_count)
+    metrics.count("mismatches", partial.mismatch_count)
+
+    if cache is not None:
+        cache.put(nginx_log.name, log_stat.st_size, log_stat.st_mtime, aggregation, partial)
+    return partial
+
+
+def get_period_logs(log_dir, regexp, last_date, days):
+    """
+    Возвращает логи за days дней, заканчивая датой last_date, по одному на каждую дату, в порядке возрастания дат
+    :param str log_dir:
+    :param str regexp:
+    :param datetime last_date:
+    :param int days:
+    :return list:
+    """
 
-    errors_count = 100.0 * mismatch_count / all_requests_count
-    if errors_count > max_errors_percent:
-        logging.error(u"Слишком много ошибок при обработке лог-файла: {:.4f}%\n Завершаем работу.".format(errors_count))
-        raise ValueError("Слишком много ошибок при обработке лог-файла.")
+    first_date = last_date - timedelta(days=days - 1)
+    period_logs = get_logs_by_date(log_dir, regexp, first_date.strftime('%Y%m%d'), last_date.strftime('%Y%m%d'))
+    return [NginxLog(period_logs[raw_date][0], parse_log_date(raw_date), period_logs[raw_date][1])
+            for raw_date in sorted(period_logs)]
 
-    report = defaultdict(lambda: defaultdict(float))
-    for url, request_time_list in urls_vs_processing_time.iteritems():
-        request_time_list.sort()
-        # request_time_list = sorted(request_time_list)
-
-        # count ‐ сколько раз встречается URL, абсолютное значение
-        count = len(request_time_list)
-        report[url]["count"] = count
-        # time_sum ‐ суммарный $request_time для данного URL'а, абсолютное значение
-        time_sum = sum(request_time_list)
-        report[url]["time_sum"] = time_sum
-        # count_perc ‐ сколько раз встречается URL, в процентнах относительно общего числа запросов
-        report[url]["count_perc"] = 100.0 * count / all_requests_count
-        # time_perc ‐ суммарный $request_time для данного URL'а, в процентах относительно общего $request_time всех
-        # запросов
-        report[url]["time_perc"] = time_sum / all_requests_time * 100
-        # time_avg ‐ средний $request_time для данного URL'а
-        report[url]["time_avg"] = time_sum / count
-        # time_max ‐ максимальный $request_time для данного URL'а
-        report[url]["time_max"] = request_time_list[-1]
-        # time_med ‐ медиана $request_time для данного URL'а
-        report[url]["time_med"] = median(request_time_list)
-
-    top_urls = sorted(report, key=lambda u: report[u]["time_sum"], reverse=True)[:report_size]
-    return top_urls, report
 
+# Разобранные шаблоны отчёта: {путь: (время изменения, начало, конец)}
+report_templates = {}
 
-def generate_report(report_template, report_name, serialized_dict):
+
+def load_report_template(report_template):
     """
-    Функция генерирует отчёт. Путём подстановки в html-шаблон сериализованного словаря-отчёта.
+    Делит html-шаблон отчёта по подстановке $table_json на начало и конец, в которых уже выполнены
+    остальные подстановки safe_substitute (например, $$ заменён на $). Результат кешируется до изменения файла
+    :param str report_template:
+    :return tuple: (начало, конец) в кодировке utf-8
+    """
+
+    mtime = os.path.getmtime(report_template)
+    cached = report_templates.get(report_template)
+    if cached is not None and cached[0] == mtime:
+        return cached[1:]
+
+    with io.open(report_template, mode='r', encoding="utf-8") as template_file:
+        text = template_file.read()
+    # Ищем подстановку тем же шаблоном, что и string.Template, чтобы не спутать её с $$table_json
+    for match in Template.pattern.finditer(text):
+        if "table_json" in (match.group("named"), match.group("braced")):
+            prefix, suffix = text[:match.start()], text[match.end():]
+            break
+    else:
+        prefix, suffix = text, u""
+    prefix = Template(prefix).safe_substitute().encode("utf-8")
+    suffix = Template(suffix).safe_substitute().encode("utf-8")
+    report_templates[report_template] = mtime, prefix, suffix
+    return prefix, suffix
+
+
+def write_report(report_template, report_name, json_chunks):
+    """
+    Функция генерирует отчёт, записывая во временный файл начало шаблона, части сериализованного
+    словаря-отчёта по мере их получения и конец шаблона. Готовый файл появляется под именем report_name целиком
     :param str report_template:
     :param str report_name:
-    :param str serialized_dict:
+    :param json_chunks: итератор частей JSON (например, iter_report_json)
     :return bool:
     """
 
     try:
-        with io.open(report_template, mode='r', encoding="utf-8") as template_file:
-            template = Template(template_file.read())
-            with tempfile.NamedTemporaryFile(dir=os.path.dirname(report_name)) as temp_file:
-                tf_fd = temp_file.fileno()
-                temp_file_with_encoding = io.open(tf_fd, mode='w', encoding="utf-8")
-                temp_file_with_encoding.write(template.safe_substitute(table_json=serialized_dict))
-                os.link(temp_file.name, report_name)
+        prefix, suffix = load_report_template(report_template)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(report_name)) as temp_file:
+            temp_file.write(prefix)
+            for chunk in json_chunks:
+                temp_file.write(chunk.encode("utf-8") if isinstance(chunk, unicode) else chunk)
+            temp_file.write(suffix)
+            temp_file.flush()
+            os.link(temp_file.name, report_name)
 
         logging.info(u"Формирование отчёта закончено. Готовый отчёт: {}".format(report_name))
 
-    except IOError, e:
+    except (IOError, OSError), e:
         logging.error(u"Ошибка ввода-вывода при создании отчёта. {}\n Завершаем работу.".format(e))
         return
     return True
 
 
+def generate_report(report_template, report_name, serialized_dict):
+    """
+    Функция генерирует отчёт. Путём подстановки в html-шаблон сериализованного словаря-отчёта.
+    :param str report_template:
+    :param str report_name:
+    :param str serialized_dict:
+    :return bool:
+    """
+
+    return write_report(report_template, report_name, [serialized_dict])
+
+
 def update_config_from_file(fname, current_config):
     """
     Функция изменяет исходный словарь-конфиг current_config согласно данным полученным из файла-конфига fname
@@ -251,16 +2177,25 @@ def update_config_from_file(fname, current_config):
     return True
 
 
-def get_config_name():
+def get_arguments():
     """
-    Функция парсит аргументы командной строки и возвращает имя конфиг файла (если задан)
-    :return str filename:
+    Функция парсит аргументы командной строки: имя конфиг файла (если задан) и режим работы
+    :return argparse.Namespace:
     """
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', default=None, const=default_cfg_file, nargs='?', help=u'Путь к конфиг файлу.')
-    args = parser.parse_args()
-    return args.config
+    parser.add_argument('--follow', action='store_true',
+                        help=u'Следить за живым логом и периодически обновлять отчёт.')
+    parser.add_argument('--backfill', action='store_true',
+                        help=u'Построить отчёты по всем логам, для которых их ещё нет.')
+    parser.add_argument('--serve', action='store_true',
+                        help=u'Сервисный режим: держать статистику живого лога в памяти и отдавать её по HTTP.')
+    parser.add_argument('--convert', action='store_true',
+                        help=u'Сохранить логи в колоночном формате в папку COLUMNS_DIR.')
+    parser.add_argument('--profile', default=None, const="log_analyzer.prof", nargs='?',
+                        help=u'Запустить под cProfile и сохранить статистику в файл (по умолчанию log_analyzer.prof).')
+    return parser.parse_args()
 
 
 def init_logging(cfg):
@@ -304,6 +2239,49 @@ def prepare_run(cfg):
     return True
 
 
+def load_discovery_state(state_file):
+    """
+    Загружает состояние поиска логов: время изменения папки с логами, последний обработанный лог и его отчёт
+    :param str state_file:
+    :return dict:
+    """
+
+    try:
+        with open(state_file) as state:
+            return json.load(state)
+    except (IOError, ValueError):
+        return
+
+
+def save_discovery_state(state_file, state):
+    """
+    Атомарно сохраняет состояние поиска логов
+    :param str state_file:
+    :param dict state:
+    """
+
+    temp_name = state_file + ".tmp"
+    with open(temp_name, 'w') as state_output:
+        json.dump(state, state_output)
+    os.rename(temp_name, state_file)
+
+
+def is_discovery_up_to_date(cfg, state, log_dir_mtime):
+    """
+    Проверяет, что с прошлого запуска в папке с логами не появилось и не пропало ни одного файла
+    (время изменения каталога не менялось), папка с отчётами та же, а отчёт по последнему логу уже построен
+    :param dict cfg:
+    :param dict state:
+    :param float log_dir_mtime:
+    :return bool:
+    """
+
+    return (state is not None and state["log_dir"] == os.path.abspath(cfg["LOG_DIR"]) and
+            state.get("report_dir") == os.path.abspath(cfg["REPORT_DIR"]) and
+            state["log_dir_mtime"] == log_dir_mtime and state["report_days"] == cfg["REPORT_DAYS"] and
+            os.path.isfile(state["report"]))
+
+
 def main(cfg):
     # Инициализируем логирование по первоначальному конфигу
     init_logging(cfg)
@@ -312,64 +2290,766 @@ def main(cfg):
     if not prepare_run(cfg):
         return
 
+    # Время изменения каталога запоминаем до чтения списка файлов: если лог появится во время поиска,
+    # то следующий запуск не сочтёт состояние актуальным
+    log_dir_mtime = os.stat(cfg["LOG_DIR"]).st_mtime
+    if cfg["DISCOVERY_STATE"]:
+        state = load_discovery_state(cfg["DISCOVERY_STATE"])
+        if is_discovery_up_to_date(cfg, state, log_dir_mtime):
+            logging.info(u"Новых логов нет, отчёт {} уже построен. Прекращаем работу.".format(state["report"]))
+            return
+
+    metrics = Metrics()
     logging.info(u"Ищем последний файл лога...")
-    last_log = get_recent_log(cfg["LOG_DIR"], regexprs["LOG_NAME_REGEXP"])
+    with metrics.timer("discovery"):
+        last_log = get_recent_log(cfg["LOG_DIR"], regexprs["LOG_NAME_REGEXP"])
     # Для обработки лог файла убедимся в его наличии
     if last_log:
         logging.info(u"Файл найден: {}".format(last_log.name))
-        report_name = os.path.join(cfg["REPORT_DIR"], "report-{}.html".format(last_log.date.strftime("%Y.%m.%d")))
+        report_date = last_log.date.strftime("%Y.%m.%d")
+        if cfg["REPORT_DAYS"] > 1:
+            report_name = os.path.join(cfg["REPORT_DIR"],
+                                       "report-{}-{}d.html".format(report_date, cfg["REPORT_DAYS"]))
+        else:
+            report_name = os.path.join(cfg["REPORT_DIR"], "report-{}.html".format(report_date))
+        state = {"log_dir": os.path.abspath(cfg["LOG_DIR"]), "log_dir_mtime": log_dir_mtime, "log": last_log.name,
+                 "report_dir": os.path.abspath(cfg["REPORT_DIR"]), "report": os.path.abspath(report_name),
+                 "report_days": cfg["REPORT_DAYS"]}
         logging.info(u"Проверяем существует ли отчёт по этому файлу:")
 
         if os.path.isfile(report_name):
             logging.info(u"Найден отчёт {} Прекращаем работу.".format(report_name))
+            if cfg["DISCOVERY_STATE"]:
+                save_discovery_state(cfg["DISCOVERY_STATE"], state)
             return
 
         logging.info(u"Отчёт не найден. Приступаем к обработке лог файла.")
-        log_iterator = read_log(os.path.join(cfg["LOG_DIR"], last_log.name), last_log.extension)
-        result = calculate_statistic(log_iterator, regexprs["NGINX_REGEXP"],
-                                     cfg["REPORT_SIZE"], cfg["MAX_ERRORS_PERCENT"])
-        # Если удалось подсчитать статистику то сформируем отчёт
-        if result:
-            top_urls, report = result
-            serialized_dict = serialize_report_dict(top_urls, report)
-            logging.info(u"Обработка закончена. Формируем отчёт.")
-            generate_report(cfg["REPORT_TEMPLATE"], report_name, serialized_dict)
+        if cfg["REPORT_DAYS"] > 1:
+            logs = get_period_logs(cfg["LOG_DIR"], regexprs["LOG_NAME_REGEXP"], last_log.date, cfg["REPORT_DAYS"])
+        else:
+            logs = [last_log]
+        if build_report(cfg, logs, report_name, metrics) and cfg["DISCOVERY_STATE"]:
+            save_discovery_state(cfg["DISCOVERY_STATE"], state)
 
     else:
         logging.info(u"Файл не найден! Завершаем работу.")
 
 
-def match_log_name(files, regexp):
+def build_report(cfg, logs, report_name, metrics=None):
     """
-    Функция-генератор, проходится по списку файлов, и возвращает имя лога, дату создания, расширение файла
-    :param files:
-    :param regexp:
-    :return:
+    Считает статистику по списку логов (используя хранилище частичных статистик, если оно задано)
+    и формирует по ней отчёт report_name. Если в конфиге задан METRICS_FORMAT, то рядом с отчётом
+    сохраняются метрики этапов обработки
+    :param dict cfg:
+    :param list logs:
+    :param str report_name:
+    :param Metrics metrics: метрики запуска, если их сбор начат раньше (например, с поиска лога)
+    :return bool:
+    """
+
+    if metrics is None:
+        metrics = Metrics()
+    cache = AggregateCache(cfg["AGGREGATE_CACHE"]) if cfg["AGGREGATE_CACHE"] else None
+    partial = merge_statistics([])
+    try:
+        # Объединяем статистики по мере подсчёта, не держа в памяти статистики всех логов сразу
+        for nginx_log in logs:
+            log_partial = get_log_statistic(cfg, nginx_log, cache, metrics)
+            with metrics.timer("merge"):
+                partial = merge_statistics([partial, log_partial])
+    finally:
+        if cache is not None:
+            cache.close()
+    metrics.counters["distinct_urls"] = len(partial.urls)
+    dimensions = get_dimensions(cfg)
+    with metrics.timer("finalize"):
+        result = finalize_statistic(partial, cfg["REPORT_SIZE"], cfg["MAX_ERRORS_PERCENT"], cfg["REPORT_PERCENTILES"])
+        tables = finalize_groups(partial, dimensions, cfg["REPORT_SIZE"], cfg["REPORT_PERCENTILES"]) \
+            if dimensions is not None else []
+    # Если удалось подсчитать статистику то сформируем отчёт
+    if result:
+        top_urls, report = result
+        logging.info(u"Обработка закончена. Формируем отчёт.")
+        with metrics.timer("report"):
+            # Дополнительные таблицы пишем раньше основного отчёта: его наличие означает, что обработка завершена
+            for name, rows in zip(dimensions.names if dimensions else [], tables):
+                table_name = get_table_report_name(report_name, name)
+                if os.path.exists(table_name):
+                    os.remove(table_name)
+                if not write_report(cfg["REPORT_TEMPLATE"], table_name, iter_json_array(rows)):
+                    return
+            success = write_report(cfg["REPORT_TEMPLATE"], report_name, iter_report_json(top_urls, report))
+        if success and cfg["METRICS_FORMAT"]:
+            metrics.write(report_name, cfg["METRICS_FORMAT"])
+        return success
+
+
+def get_table_report_name(report_name, grouping_name):
+    """
+    Возвращает имя файла дополнительной таблицы отчёта, например report-2017.06.30-by-status_class.html
+    :param str report_name:
+    :param str grouping_name:
+    :return str:
     """
 
-    pattern = re.compile(regexp)
+    base_name, extension = os.path.splitext(report_name)
+    return "{}-by-{}{}".format(base_name, grouping_name, extension)
 
-    for file_name in files:
-        match = pattern.search(file_name)
-        if match:
+
+def get_unreported_logs(log_dir, regexp, report_dir):
+    """
+    Возвращает логи (по одному на дату, в порядке возрастания дат), для которых ещё нет отчёта в report_dir
+    :param str log_dir:
+    :param str regexp:
+    :param str report_dir:
+    :return list:
+    """
+
+    logs = []
+    for raw_date, (log_name, log_ext) in sorted(get_logs_by_date(log_dir, regexp).iteritems()):
+        report_name = os.path.join(report_dir, "report-{}.{}.{}.html".format(raw_date[:4], raw_date[4:6], raw_date[6:]))
+        if not os.path.isfile(report_name):
+            logs.append(NginxLog(log_name, parse_log_date(raw_date), log_ext))
+    return logs
+
+
+def backfill_log(task):
+    """
+    Функция для процессов-обработчиков догоняющего режима: строит отчёт по одному логу.
+    Ошибка обработки не прерывает остальные логи, а возвращается в результате
+    :param tuple task: (конфиг, лог)
+    :return dict: имя лога, успех, время обработки в секундах, текст ошибки
+    """
+
+    cfg, nginx_log = task
+    report_name = os.path.join(cfg["REPORT_DIR"], "report-{}.html".format(nginx_log.date.strftime("%Y.%m.%d")))
+    started = time.time()
+    error = None
+    try:
+        success = bool(build_report(cfg, [nginx_log], report_name))
+    except Exception as e:
+        logging.exception(u"Ошибка обработки лога {}".format(nginx_log.name))
+        success, error = False, repr(e)
+    seconds = time.time() - started
+    logging.info(u"Лог {} обработан за {:.3f} с".format(nginx_log.name, seconds))
+    return {"log": nginx_log.name, "success": success, "seconds": seconds, "error": error}
+
+
+def send_backfill_result(task, connection):
+    """
+    Функция отдельного процесса догоняющего режима: строит отчёт по одному логу и отправляет результат родителю
+    :param tuple task: (конфиг, лог)
+    :param connection: конец канала multiprocessing.Pipe для отправки
+    """
+
+    connection.send(backfill_log(task))
+    connection.close()
+
+
+def wait_backfill_process(process, connection, nginx_log, started, results, semaphore):
+    """
+    Ждёт результат процесса, обрабатывающего лог, и освобождает место в semaphore. Если процесс упал, не отправив
+    результат (нехватка памяти, segfault), или завершился с ненулевым кодом, лог считается не обработанным.
+    Выполняется в отдельном потоке, поэтому ничего не пишет в лог: блокировки logging не должны оказаться занятыми
+    при запуске следующего процесса
+    :param multiprocessing.Process process:
+    :param connection: конец канала multiprocessing.Pipe для получения результата
+    :param NginxLog nginx_log:
+    :param float started: время запуска процесса
+    :param list results: список, в который добавляется результат
+    :param threading.BoundedSemaphore semaphore:
+    """
+
+    try:
+        try:
+            result = connection.recv()
+        except EOFError:
+            result = {"log": nginx_log.name, "success": False, "seconds": time.time() - started, "error": None}
+        finally:
+            connection.close()
+            process.join()
+        result["exitcode"] = process.exitcode
+        if process.exitcode:
+            result.update({"success": False, "error": "exitcode {}".format(process.exitcode)})
+        results.append(result)
+    finally:
+        semaphore.release()
+
+
+def backfill(cfg):
+    """
+    Догоняющий режим: строит отчёты по всем логам, для которых их ещё нет, одновременно не больше чем
+    в BACKFILL_WORKERS процессах, по отдельному процессу на лог. Упавший процесс не останавливает обработку,
+    а его лог считается не обработанным. Время обработки каждого лога сохраняется в REPORT_DIR/backfill-timings.json
+    :param dict cfg:
+    :return list: результаты обработки логов
+    """
+
+    init_logging(cfg)
+    if not prepare_run(cfg):
+        return
+
+    logs = get_unreported_logs(cfg["LOG_DIR"], regexprs["LOG_NAME_REGEXP"], cfg["REPORT_DIR"])
+    logging.info(u"Логов без отчёта: {}".format(len(logs)))
+    if not logs:
+        return []
+
+    workers = min(cfg["BACKFILL_WORKERS"], len(logs))
+    log_cfg = cfg.copy()
+    # Логи и так обрабатываются параллельно, поэтому каждый лог обрабатываем в одном процессе
+    if workers > 1:
+        log_cfg["WORKERS"] = 1
+    tasks = [(log_cfg, nginx_log) for nginx_log in logs]
+
+    if workers > 1:
+        # Процессы запускаются только из основного потока, потоки лишь ждут их результатов
+        results = []
+        semaphore = threading.BoundedSemaphore(workers)
+        threads = []
+        for task in tasks:
+            semaphore.acquire()
+            parent_connection, child_connection = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=send_backfill_result, args=(task, child_connection))
+            process.start()
+            # Иначе recv не получит EOFError, если процесс упадёт, не отправив результат
+            child_connection.close()
+            thread = threading.Thread(target=wait_backfill_process, args=(process, parent_connection, task[1],
+                                                                          time.time(), results, semaphore))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        for result in results:
+            if result["exitcode"]:
+                logging.error(u"Процесс обработки лога {} завершился с кодом {}".format(result["log"],
+                                                                                       result["exitcode"]))
+    else:
+        results = [backfill_log(task) for task in tasks]
+
+    results.sort(key=lambda result: result["log"])
+    with open(os.path.join(cfg["REPORT_DIR"], "backfill-timings.json"), 'w') as timings_file:
+        json.dump(results, timings_file, indent=2)
+    failed = [result["log"] for result in results if not result["success"]]
+    if failed:
+        logging.error(u"Не удалось обработать логи: {}".format(", ".join(failed)))
+    return results
+
+
+class LogFollower(object):
+    """
+    Читает новые строки живого лога, запоминая inode файла и смещение уже прочитанных данных.
+    При ротации (живой лог переименован в датированный файл) дочитывает хвост старого файла,
+    найдя его по inode среди логов подходящих под regexp, и переключается на новый файл. Если лог сразу сжат
+    при ротации, хвост дочитывается из самого свежего сжатого лога после распаковки прочитанной части.
+    """
+
+    def __init__(self, log_dir, log_name, regexp, inode=None, offset=0, decode=True):
+        self.log_dir = log_dir
+        self.decode = decode
+        self.log_full_name = os.path.join(log_dir, log_name)
+        self.regexp = regexp
+        self.inode = inode
+        self.offset = offset
+        self.rotated = False
+
+    def find_rotated_log(self):
+        """
+        Ищет ротированный лог с прежним inode. Сжатый при ротации лог имеет новый inode, поэтому если несжатого
+        лога с прежним inode нет, возвращает самый свежий сжатый лог
+        :return str:
+        """
+
+        newest_gz = None
+        for log_name, raw_date, log_ext in scan_log_names(self.log_dir, self.regexp):
+            log_full_name = os.path.join(self.log_dir, log_name)
+            if log_ext != '.gz':
+                if os.stat(log_full_name).st_ino == self.inode:
+                    return log_full_name
+            elif newest_gz is None or raw_date > newest_gz[0]:
+                newest_gz = raw_date, log_full_name
+        if newest_gz is not None:
+            return newest_gz[1]
+
+    def read_new_lines(self):
+        """
+        Функция - генератор. Возвращает строки, появившиеся после последнего чтения.
+        Если лог был ротирован, то возвращает хвост старого файла и выставляет флаг rotated,
+        новый файл будет прочитан при следующем вызове
+        """
+
+        self.rotated = False
+        try:
+            log_stat = os.stat(self.log_full_name)
+        except OSError:
+            log_stat = None
+
+        if self.inode is not None and (log_stat is None or log_stat.st_ino != self.inode):
+            rotated_log = self.find_rotated_log()
+            if rotated_log:
+                for line in self._read_from(rotated_log):
+                    yield line
+            else:
+                logging.warning(u"Ротированный лог не найден, хвост старого файла пропущен.")
+            self.rotated = True
+            self.inode = log_stat.st_ino if log_stat else None
+            self.offset = 0
+            return
+
+        if log_stat is None:
+            return
+        if self.inode is None:
+            self.inode = log_stat.st_ino
+        # Файл обрезали - читаем его сначала
+        if log_stat.st_size < self.offset:
+            self.offset = 0
+        for line in self._read_from(self.log_full_name):
+            yield line
+
+    def _read_from(self, log_full_name):
+        if log_full_name.endswith('.gz'):
             try:
-                cur_date = datetime.strptime(match.group(1), '%Y%m%d')
-                yield match.group(0), cur_date, match.group(2)
-            except ValueError as error:
-                logging.error(u"Ошибка парсинга даты.{}\n Завершаем работу.".format(error))
-                raise error
+                for line in self._read_lines(gzip.open(log_full_name, 'rb'), log_full_name):
+                    yield line
+            except (IOError, EOFError, zlib.error) as error:
+                logging.warning(u"Сжатый лог {} не дописан или повреждён, хвост старого файла пропущен: {}".format(
+                    log_full_name, error))
+            return
+        for line in self._read_lines(io.open(log_full_name, mode='rb'), log_full_name):
+            yield line
+
+    def _read_lines(self, log_file, log_full_name):
+        with log_file:
+            # Сжатый файл при переходе по смещению распаковывается до него
+            log_file.seek(self.offset)
+            if log_file.tell() < self.offset:
+                logging.warning(u"Лог {} короче прочитанной части, хвост старого файла пропущен.".format(
+                    log_full_name))
+                return
+            while True:
+                line = log_file.readline()
+                # Недописанную строку оставляем до следующего чтения
+                if not line.endswith('\n'):
+                    break
+                self.offset += len(line)
+                yield line.decode('utf-8') if self.decode else line
+
+
+def load_checkpoint(checkpoint_file):
+    """
+    Загружает контрольную точку режима слежения: inode, смещение и накопленную частичную статистику
+    :param str checkpoint_file:
+    :return tuple:
+    """
+
+    try:
+        with open(checkpoint_file, 'rb') as checkpoint:
+            state = cPickle.load(checkpoint)
+    except IOError:
+        return None, 0, None
+    partial = PartialStatistic(*state["partial"]) if state["partial"] else None
+    return state["inode"], state["offset"], partial
+
+
+def save_checkpoint(checkpoint_file, inode, offset, partial):
+    """
+    Атомарно сохраняет контрольную точку режима слежения
+    :param str checkpoint_file:
+    :param int inode:
+    :param int offset:
+    :param PartialStatistic partial:
+    """
+
+    state = {"inode": inode, "offset": offset, "partial": tuple(partial) if partial else None}
+    temp_name = checkpoint_file + ".tmp"
+    with open(temp_name, 'wb') as checkpoint:
+        cPickle.dump(state, checkpoint, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temp_name, checkpoint_file)
+
+
+def update_statistic(partial, log_iterator, nginx_regex, accumulator_factory=ExactAccumulator, parser_type="regex",
+                     url_normalizer=None):
+    """
+    Инкрементальная версия подсчёта: добавляет к частичной статистике partial только новые строки
+    :param PartialStatistic partial:
+    :param log_iterator:
+    :param str nginx_regex:
+    :param accumulator_factory:
+    :param str parser_type:
+    :param UrlNormalizer url_normalizer:
+    :return PartialStatistic:
+    """
+
+    new_partial = collect_statistic(log_iterator, nginx_regex, accumulator_factory, parser_type, url_normalizer)
+    if partial is None:
+        return new_partial
+    return merge_statistics([partial, new_partial])
+
+
+def warn_exact_follow(cfg):
+    """
+    Предупреждает, что в режимах слежения точная агрегация хранит все значения времени с момента ротации,
+    и итоговая статистика при каждом обновлении обходит их все
+    :param dict cfg:
+    """
+
+    if cfg["AGGREGATION"] == "exact":
+        logging.warning(u"Точная агрегация в режиме слежения: время обновления растёт вместе с логом, "
+                        u"рекомендуется AGGREGATION=sketch.")
+
+
+def checkpoint_due(last_saved, cfg):
+    """
+    Возвращает True, если с сохранения контрольной точки прошло не меньше FOLLOW_CHECKPOINT_INTERVAL секунд
+    :param float last_saved:
+    :param dict cfg:
+    :return bool:
+    """
+
+    return time.time() - last_saved >= cfg["FOLLOW_CHECKPOINT_INTERVAL"]
+
+
+def follow_log(cfg, iterations=None):
+    """
+    Режим слежения за живым логом: раз в FOLLOW_INTERVAL секунд дочитывает новые строки,
+    обновляет статистику и перезаписывает отчёт. При ротации лога статистика начинается заново.
+    Контрольная точка (смещение вместе с накопленной статистикой) сохраняется раз в FOLLOW_CHECKPOINT_INTERVAL
+    секунд, при ротации и при завершении: её запись зависит от размера статистики. После аварийной остановки
+    строки после последней контрольной точки просто читаются заново
+    :param dict cfg:
+    :param int iterations: количество обновлений, None - бесконечно
+    """
+
+    init_logging(cfg)
+    if not prepare_run(cfg):
+        return
+    warn_exact_follow(cfg)
+
+    checkpoint_file = cfg["FOLLOW_CHECKPOINT"]
+    inode, offset, partial = load_checkpoint(checkpoint_file)
+    follower = LogFollower(cfg["LOG_DIR"], cfg["FOLLOW_LOG"], regexprs["LOG_NAME_REGEXP"], inode, offset,
+                           decode=cfg["PARSER"] == "regex")
+    accumulator_factory = get_accumulator_factory(cfg)
+    url_normalizer = get_url_normalizer(cfg)
+    report_name = os.path.join(cfg["REPORT_DIR"], "report-live.html")
+    logging.info(u"Следим за логом {}, смещение {}".format(follower.log_full_name, offset))
+    last_saved = time.time()
+
+    try:
+        while iterations is None or iterations > 0:
+            previous_count = partial.requests_count if partial else 0
+            partial = update_statistic(partial, follower.read_new_lines(), regexprs["NGINX_REGEXP"],
+                                       accumulator_factory, cfg["PARSER"], url_normalizer)
+            # Итоговая статистика зависит от числа различных url, поэтому без новых строк отчёт не пересчитываем
+            if partial.requests_count > previous_count:
+                try:
+                    top_urls, report = finalize_statistic(partial, cfg["REPORT_SIZE"], cfg["MAX_ERRORS_PERCENT"],
+                                                          cfg["REPORT_PERCENTILES"])
+                except ValueError:
+                    pass
+                else:
+                    temp_report_name = report_name + ".tmp"
+                    if os.path.exists(temp_report_name):
+                        os.remove(temp_report_name)
+                    if write_report(cfg["REPORT_TEMPLATE"], temp_report_name, iter_report_json(top_urls, report)):
+                        os.rename(temp_report_name, report_name)
+
+            if follower.rotated:
+                logging.info(u"Лог ротирован, начинаем статистику заново.")
+                partial = None
+            if follower.rotated or checkpoint_due(last_saved, cfg):
+                save_checkpoint(checkpoint_file, follower.inode, follower.offset, partial)
+                last_saved = time.time()
+
+            if iterations is not None:
+                iterations -= 1
+                if not iterations:
+                    break
+            time.sleep(cfg["FOLLOW_INTERVAL"])
+    finally:
+        save_checkpoint(checkpoint_file, follower.inode, follower.offset, partial)
+
+
+class StatsService(object):
+    """
+    Состояние сервисного режима: статистика живого лога, которая хранится в памяти и дополняется новыми строками
+    (через LogFollower и контрольную точку режима слежения), и снимок топа адресов для HTTP-запросов.
+    Под блокировкой, общей с запросами, только объединяются новые строки со статистикой (это зависит от числа новых
+    url, а не от размера статистики) и подменяются ссылки на снимок топа. Разбор новых строк, итоговая статистика
+    и контрольная точка считаются без блокировки: накопители меняет только обновление, запросы их лишь читают.
+    Статистика отдельного url считается без блокировки при первом запросе и кешируется до следующего обновления
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.lock = threading.Lock()
+        inode, offset, self.partial = load_checkpoint(cfg["FOLLOW_CHECKPOINT"])
+        self.follower = LogFollower(cfg["LOG_DIR"], cfg["FOLLOW_LOG"], regexprs["LOG_NAME_REGEXP"], inode, offset,
+                                    decode=cfg["PARSER"] == "regex")
+        self.accumulator_factory = get_accumulator_factory(cfg)
+        self.url_normalizer = get_url_normalizer(cfg)
+        # Строки топа адресов (см. iter_report_rows) и их JSON на момент последнего обновления
+        self.top_rows = []
+        self.top_json = "[]"
+        self.url_statistics = {}
+        self.updated = None
+        self.error = None
+        # Последнее согласованное состояние для контрольной точки: inode, смещение и статистика
+        self.checkpoint_state = (inode, offset, self.partial)
+        self.checkpoint_saved = time.time()
+        warn_exact_follow(cfg)
+
+    def update(self):
+        """
+        Дочитывает новые строки живого лога и обновляет статистику и снимок топа адресов.
+        При ротации лога снимок ещё содержит хвост старого файла, а статистика начинается заново
+        :return int: количество новых строк
+        """
+
+        new_partial = collect_statistic(self.follower.read_new_lines(), regexprs["NGINX_REGEXP"],
+                                        self.accumulator_factory, self.cfg["PARSER"], self.url_normalizer)
+        rotated = self.follower.rotated
+        with self.lock:
+            if self.partial is None:
+                self.partial = new_partial
+            elif new_partial.requests_count:
+                # Накопители новых url добавляются в словарь статистики на месте, без копирования всех url
+                merge_accumulators(self.partial.urls, new_partial.urls)
+                self.partial = self.partial._replace(
+                    requests_count=self.partial.requests_count + new_partial.requests_count,
+                    requests_time=self.partial.requests_time + new_partial.requests_time,
+                    mismatch_count=self.partial.mismatch_count + new_partial.mismatch_count)
+            if new_partial.requests_count or rotated:
+                self.url_statistics = {}
+            partial = self.partial
+            if rotated:
+                logging.info(u"Лог ротирован, начинаем статистику заново.")
+                self.partial = None
+            inode, offset = self.follower.inode, self.follower.offset
+            self.updated = time.time()
+
+        # Без новых строк топ не меняется, а итоговая статистика обходит все url
+        if new_partial.requests_count:
+            top_rows, top_json, error = self._finalize(partial)
+            with self.lock:
+                self.error = error
+                if top_rows is not None:
+                    self.top_rows, self.top_json = top_rows, top_json
+
+        self.checkpoint_state = (inode, offset, None if rotated else partial)
+        if rotated or checkpoint_due(self.checkpoint_saved, self.cfg):
+            self.save()
+        return new_partial.requests_count
+
+    def save(self):
+        """
+        Сохраняет контрольную точку по состоянию на последнее обновление
+        """
+
+        save_checkpoint(self.cfg["FOLLOW_CHECKPOINT"], *self.checkpoint_state)
+        self.checkpoint_saved = time.time()
+
+    def _finalize(self, partial):
+        """
+        Возвращает строки топа адресов, их JSON и текст ошибки. Если статистика пуста или ошибок слишком много,
+        строки и JSON - None, и остаётся прежний снимок
+        :param PartialStatistic partial:
+        :return tuple:
+        """
+
+        if not partial.requests_count:
+            return None, None, None
+        try:
+            top_urls, report = finalize_statistic(partial, self.cfg["REPORT_SIZE"], self.cfg["MAX_ERRORS_PERCENT"],
+                                                  self.cfg["REPORT_PERCENTILES"])
+        except ValueError as error:
+            return None, None, unicode(error)
+        top_rows = list(iter_report_rows(top_urls, report))
+        return top_rows, json.dumps(top_rows), None
+
+    def top(self, limit=None):
+        """
+        Возвращает JSON топа адресов, не больше limit строк
+        :param int limit:
+        :return str:
+        """
+
+        with self.lock:
+            if limit is None or limit >= len(self.top_rows):
+                return self.top_json
+            return json.dumps(self.top_rows[:limit])
+
+    def url_statistic(self, url):
+        """
+        Возвращает статистику url (после нормализации, если она включена) или None, если запросов к нему не было
+        :param unicode url:
+        :return dict:
+        """
+
+        with self.lock:
+            statistic = self.url_statistics.get(url)
+            partial = self.partial
+            url_statistics = self.url_statistics
+        if statistic is not None or partial is None:
+            return statistic
+        # Быстрый парсер хранит url байтами, регулярное выражение - строками unicode
+        for key in (url, url.encode('utf-8')):
+            if self.url_normalizer is not None:
+                key = self.url_normalizer(key)
+            accumulator = partial.urls.get(key)
+            if accumulator is not None:
+                # Считается без блокировки, чтобы не задерживать обновление и другие запросы. Если за это время
+                # пришло обновление, результат попадёт только в уже сброшенный кеш прежней статистики
+                statistic = {"url": url}
+                fill_statistic(statistic, accumulator, partial.requests_count, partial.requests_time,
+                               self.cfg["REPORT_PERCENTILES"])
+                url_statistics[url] = statistic
+                return statistic
+
+    def summary(self):
+        """
+        Возвращает общие сведения о статистике: количество строк, несовпадений и различных url, смещение в логе
+        :return dict:
+        """
+
+        with self.lock:
+            partial = self.partial
+            return {
+                "log": self.follower.log_full_name,
+                "offset": self.follower.offset,
+                "requests_count": partial.requests_count if partial else 0,
+                "mismatch_count": partial.mismatch_count if partial else 0,
+                "urls": len(partial.urls) if partial else 0,
+                "updated": self.updated,
+                "error": self.error,
+            }
+
+
+class StatsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Обработчик HTTP-запросов сервисного режима:
+    /top?limit=N - топ адресов в JSON, /url?url=... - статистика одного url, /stats - общие сведения,
+    /report - html-отчёт по текущему топу (снимок по запросу)
+    """
+
+    def do_GET(self):
+        service = self.server.service
+        request = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(request.query)
+        try:
+            if request.path == "/top":
+                limit = int(query["limit"][0]) if "limit" in query else None
+                self._send(200, "application/json", [service.top(limit)])
+            elif request.path == "/url":
+                if "url" not in query:
+                    self._send(400, "application/json", [json.dumps({"error": "url is required"})])
+                    return
+                statistic = service.url_statistic(query["url"][0].decode('utf-8'))
+                if statistic is None:
+                    self._send(404, "application/json", [json.dumps({"error": "url not found"})])
+                else:
+                    self._send(200, "application/json", [json.dumps(statistic)])
+            elif request.path == "/stats":
+                self._send(200, "application/json", [json.dumps(service.summary())])
+            elif request.path == "/report":
+                prefix, suffix = load_report_template(service.cfg["REPORT_TEMPLATE"])
+                # Список строк топа при обновлении заменяется целиком, поэтому его можно отдавать без блокировки
+                self._send(200, "text/html; charset=utf-8",
+                           itertools.chain([prefix], iter_json_array(service.top_rows), [suffix]))
+            else:
+                self._send(404, "application/json", [json.dumps({"error": "not found"})])
+        except ValueError as error:
+            self._send(400, "application/json", [json.dumps({"error": unicode(error)})])
+
+    def _send(self, code, content_type, chunks):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(chunk.encode("utf-8") if isinstance(chunk, unicode) else chunk)
+
+    def log_message(self, format, *args):
+        logging.debug(u"{} {}".format(self.client_address[0], format % args))
+
+
+class StatsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    HTTP-сервер сервисного режима, каждый запрос обрабатывается в отдельном потоке
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StatsRequestHandler)
+        self.service = service
+
+
+def serve(cfg, iterations=None):
+    """
+    Сервисный режим: держит статистику живого лога в памяти, раз в FOLLOW_INTERVAL секунд дочитывает новые строки
+    и отвечает на HTTP-запросы на SERVICE_HOST:SERVICE_PORT (см. StatsRequestHandler)
+    :param dict cfg:
+    :param int iterations: количество обновлений, None - бесконечно
+    """
+
+    init_logging(cfg)
+    if not prepare_run(cfg):
+        return
+
+    service = StatsService(cfg)
+    server = StatsServer((cfg["SERVICE_HOST"], cfg["SERVICE_PORT"]), service)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    logging.info(u"Статистика лога {} доступна на http://{}:{}/".format(service.follower.log_full_name,
+                                                                       *server.server_address))
+    try:
+        while iterations is None or iterations > 0:
+            started = time.time()
+            lines = service.update()
+            logging.debug(u"Обработано новых строк: {} за {:.3f} с".format(lines, time.time() - started))
+            if iterations is not None:
+                iterations -= 1
+                if not iterations:
+                    break
+            time.sleep(cfg["FOLLOW_INTERVAL"])
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.save()
 
 
 if __name__ == "__main__":
     try:
         # Далее конфиг будем перезаписывать, поэтому сделаем копию.
         cfg = config.copy()
-        config_file_name = get_config_name()
+        args = get_arguments()
         # Если было задано имя конфиг файла, то обновляем локальный конфиг и обновляем логирование
-        if config_file_name:
-            update_config_from_file(config_file_name, cfg)
+        if args.config:
+            update_config_from_file(args.config, cfg)
+
+        if args.follow:
+            run = follow_log
+        elif args.backfill:
+            run = backfill
+        elif args.convert:
+            run = convert_logs
+        elif args.serve:
+            run = serve
+        else:
+            run = main
 
-        main(cfg)
+        if args.profile:
+            # Профилируется только основной процесс, работа процессов-обработчиков в статистику не попадает
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(run, cfg)
+            finally:
+                profiler.dump_stats(args.profile)
+                logging.info(u"Статистика профилировщика сохранена в {}".format(args.profile))
+        else:
+            run(cfg)
     except Exception as e:
         logging.exception(e.message)
     logging.shutdown()
@@ -3,9 +3,21 @@
 import unittest
 import datetime
 import os
+import shutil
+import tempfile
+import gzip
+import json
+import io
+import cPickle
+from string import Template
+import threading
+import signal
+import urllib
+import urllib2
 
 try:
     from log_analyzer import log_analyzer
+    from log_analyzer.benchmarks import log_generator
 
 except ImportError as error:
     print "Для работы тестов установите пакет log_analyzer"
@@ -59,12 +71,123 @@ class TestLogAnalyzer(unittest.TestCase):
         self.assertEquals(log_date, datetime.datetime(2017, 7, 20, 0, 0))
         self.assertIsNone(log_type)
 
+    def test_discovery(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            log_dir = os.path.join(temp_dir, 'log')
+            os.mkdir(log_dir)
+            with open('./logs/nginx-access-ui.log-20170720') as log_file:
+                log_content = log_file.read()
+            for log_name in ('nginx-access-ui.log-20170719.gz', 'nginx-access-ui.log-20170720.gz',
+                             'nginx-access-ui.log-20170721.gz'):
+                with gzip.open(os.path.join(temp_dir, log_name), 'wb') as log_file:
+                    log_file.write(log_content)
+            for log_name in ('nginx-access-ui.log-20170719.gz', 'nginx-access-ui.log-20170720.gz'):
+                shutil.copy(os.path.join(temp_dir, log_name), log_dir)
+            open(os.path.join(log_dir, 'other.log'), 'w').close()
+            # За одну дату есть и сжатый, и несжатый лог - читается только несжатый
+            shutil.copy('./logs/nginx-access-ui.log-20170720', os.path.join(log_dir, 'nginx-access-ui.log-20170720'))
+            regexp = log_analyzer.regexprs["LOG_NAME_REGEXP"]
+            self.assertEquals(log_analyzer.get_recent_log(log_dir, regexp),
+                              ('nginx-access-ui.log-20170720', datetime.datetime(2017, 7, 20), None))
+            self.assertEquals([log.name for log in log_analyzer.get_period_logs(
+                log_dir, regexp, datetime.datetime(2017, 7, 20), 3)],
+                ['nginx-access-ui.log-20170719.gz', 'nginx-access-ui.log-20170720'])
+
+            cfg = log_analyzer.config.copy()
+            cfg.update({"LOG_DIR": log_dir, "REPORT_DIR": os.path.join(temp_dir, 'reports'),
+                        "REPORT_TEMPLATE": './reports/report.html', "LOGLEVEL": 50,
+                        "DISCOVERY_STATE": os.path.join(temp_dir, 'discovery.state')})
+            log_analyzer.main(cfg)
+            state = log_analyzer.load_discovery_state(cfg["DISCOVERY_STATE"])
+            self.assertEquals(state["log"], 'nginx-access-ui.log-20170720')
+            self.assertTrue(os.path.isfile(state["report"]))
+
+            # Пока в папке с логами ничего не менялось, логи не ищутся
+            get_recent_log = log_analyzer.get_recent_log
+            searched = []
+            log_analyzer.get_recent_log = lambda *args: searched.append(args) or get_recent_log(*args)
+            try:
+                log_analyzer.main(cfg)
+                self.assertEquals(searched, [])
+                shutil.copy(os.path.join(temp_dir, 'nginx-access-ui.log-20170721.gz'), log_dir)
+                log_analyzer.main(cfg)
+                self.assertEquals(len(searched), 1)
+                # После смены папки с отчётами отчёт строится заново в новой папке
+                cfg["REPORT_DIR"] = os.path.join(temp_dir, 'reports-new')
+                log_analyzer.main(cfg)
+                self.assertEquals(len(searched), 2)
+                self.assertTrue(os.path.isfile(os.path.join(cfg["REPORT_DIR"], 'report-2017.07.21.html')))
+            finally:
+                log_analyzer.get_recent_log = get_recent_log
+            self.assertEquals(log_analyzer.load_discovery_state(cfg["DISCOVERY_STATE"])["log"],
+                              'nginx-access-ui.log-20170721.gz')
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_read_log(self):
         i = 0
         for line in log_analyzer.read_log('./logs/nginx-access-ui.log-20170720', None):
             self.assertEquals(line.strip(), self.log_content[i])
             i += 1
 
+    def test_read_log_gzip_readers(self):
+        temp_dir = tempfile.mkdtemp()
+        log_name = os.path.join(temp_dir, 'nginx-access-ui.log-20170720.gz')
+        try:
+            # Файл из двух склеенных gzip-потоков
+            for line in self.log_content:
+                gz_file = gzip.open(log_name, 'ab')
+                gz_file.write(line + '\n')
+                gz_file.close()
+            for gzip_reader in ("gzip", "zlib", "thread", "process"):
+                lines = [line.strip() for line in log_analyzer.read_log(log_name, '.gz', gzip_reader=gzip_reader,
+                                                                        block_size=64)]
+                self.assertEquals(lines, self.log_content)
+
+            # Нулевые байты в конце файла пропускаются, как в модуле gzip, а между gzip-потоками - всеми способами
+            # распаковки, кроме внешней программы (gzip считает их концом файла)
+            with open(log_name, 'ab') as gz_file:
+                gz_file.write('\0' * 100)
+            for gzip_reader in ("gzip", "zlib", "thread", "process"):
+                lines = [line.strip() for line in log_analyzer.read_log(log_name, '.gz', gzip_reader=gzip_reader,
+                                                                        block_size=64)]
+                self.assertEquals(lines, self.log_content)
+            with open(log_name, 'wb') as gz_file:
+                for line in self.log_content:
+                    with gzip.GzipFile(fileobj=gz_file, mode='wb') as gz_stream:
+                        gz_stream.write(line + '\n')
+                    gz_file.write('\0' * 100)
+            for gzip_reader in ("gzip", "zlib", "thread"):
+                lines = [line.strip() for line in log_analyzer.read_log(log_name, '.gz', gzip_reader=gzip_reader,
+                                                                        block_size=64)]
+                self.assertEquals(lines, self.log_content)
+
+            # Поток распаковки завершается, даже если чтение прекращено раньше конца файла
+            with gzip.open(log_name, 'wb') as gz_file:
+                gz_file.write((self.log_content[0] + '\n') * 10000)
+            threads = threading.active_count()
+            lines = log_analyzer.read_log(log_name, '.gz', gzip_reader="thread", block_size=64)
+            self.assertEquals(next(lines).strip(), self.log_content[0])
+            lines.close()
+            self.assertEquals(threading.active_count(), threads)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_read_log_mmap(self):
+        log_name = './logs/nginx-access-ui.log-20170720_'
+        lines = [line.rstrip('\n') for line in log_analyzer.read_log(log_name, None, decode=False)]
+        for block_size in (1, 100, 1 << 20):
+            self.assertEquals(list(log_analyzer.read_log(log_name, None, decode=False, block_size=block_size,
+                                                         plain_reader="mmap")), lines)
+        chunk_lines = []
+        for start, end in log_analyzer.split_log_chunks(log_name, 3):
+            chunk_lines.extend(log_analyzer.read_log_chunk(log_name, start, end, decode=False, plain_reader="mmap",
+                                                           block_size=150))
+        self.assertEquals(chunk_lines, lines)
+        self.assertEquals(list(log_analyzer.read_log('./logs/nginx-access-ui.log-20170630', None,
+                                                     plain_reader="mmap")), [])
+
     def test_median(self):
         self.assertEquals(log_analyzer.median([1, 2, 3]), 2)
         self.assertEquals(log_analyzer.median([1, 2, 3, 4]), 2.5)
@@ -80,6 +203,566 @@ class TestLogAnalyzer(unittest.TestCase):
         self.assertDictEqual(self.report_dict, report)
         self.assertEquals(self.top_urls, top_urls)
 
+    def test_split_log_chunks(self):
+        log_name = './logs/nginx-access-ui.log-20170720_'
+        chunks = log_analyzer.split_log_chunks(log_name, 4)
+        self.assertEquals(chunks[0][0], 0)
+        self.assertEquals(chunks[-1][1], os.path.getsize(log_name))
+        lines = []
+        for start, end in chunks:
+            lines.extend(log_analyzer.read_log_chunk(log_name, start, end))
+        self.assertEquals(lines, list(log_analyzer.read_log(log_name, None)))
+
+    def test_calculate_statistic_top(self):
+        log_name = './logs/nginx-access-ui.log-20170720_'
+        regexp = log_analyzer.regexprs["NGINX_REGEXP"]
+        top_urls, report = log_analyzer.calculate_statistic(log_analyzer.read_log(log_name, None), regexp, 100, 0)
+        short_top_urls, short_report = log_analyzer.calculate_statistic(log_analyzer.read_log(log_name, None),
+                                                                        regexp, 3, 0)
+        self.assertEquals(short_top_urls, top_urls[:3])
+        self.assertEquals(sorted(short_report), sorted(top_urls[:3]))
+        self.assertEquals(top_urls, sorted(report, key=lambda url: report[url]["time_sum"], reverse=True))
+
+    def test_calculate_statistic_parallel(self):
+        log_name = './logs/nginx-access-ui.log-20170720_'
+        regexp = log_analyzer.regexprs["NGINX_REGEXP"]
+        top_urls, report = log_analyzer.calculate_statistic(log_analyzer.read_log(log_name, None), regexp, 5, 0)
+        par_top_urls, par_report = log_analyzer.calculate_statistic_parallel(log_name, regexp, 5, 0, 3)
+        self.assertEquals(top_urls, par_top_urls)
+        for url in top_urls:
+            self.assertEquals(report[url]["count"], par_report[url]["count"])
+            self.assertAlmostEqual(report[url]["time_perc"], par_report[url]["time_perc"])
+            self.assertAlmostEqual(report[url]["time_med"], par_report[url]["time_med"])
+
+    def test_fast_parser(self):
+        regexp = log_analyzer.regexprs["NGINX_REGEXP"]
+        regex_parse = log_analyzer.line_parsers["regex"](regexp)
+        fast_parse = log_analyzer.line_parsers["fast"](regexp)
+        lines = list(log_analyzer.read_log('./logs/nginx-access-ui.log-20170720_', None, decode=False))
+        lines += ['"GET /a\tb HTTP/1.1" 200 "-" 0.1\n', 'no quotes 0.1', '"get /a HTTP/1.1" "-" 0.1',
+                  '"GET /a HTTP/1.1" "-"\t0.1', '"GET /a HTTP/1.1" "-" 0.1\r\n', '"GET /a" 0.1', '"GET /url"',
+                  'x "GET /a "POST /b HTTP/1.1" "-" 0.1', '"GET /\xd0\xb0 HTTP/1.1" 200 "-" 0.2\n']
+        for line in lines:
+            parsed = fast_parse(line)
+            if parsed:
+                parsed = parsed[0].decode('utf-8'), parsed[1]
+            self.assertEquals(parsed, regex_parse(line.decode('utf-8')))
+
+    def test_url_normalizer(self):
+        normalizer = log_analyzer.UrlNormalizer(strip_query=True, replace_ids=True,
+                                                rewrites=[[r'^/api/v\d+/', '/api/']], cache_size=4)
+        self.assertEquals(normalizer('/api/v2/banner/25019354'), '/api/banner/{id}')
+        self.assertEquals(normalizer('/api/v2/group/7786679/statistic/sites/?date_type=day'),
+                          '/api/group/{id}/statistic/sites/')
+        self.assertEquals(normalizer('/export/appinstall_raw/2017-06-29/'), '/export/appinstall_raw/2017-06-29/')
+        self.assertEquals(normalizer('/static/1a2b3c4d5e/deadbeefcafe'), '/static/{id}/deadbeefcafe')
+        self.assertIs(normalizer('/api/v2/banner/1'), normalizer('/api/v1/banner/2'))
+        self.assertLessEqual(len(normalizer.recent) + len(normalizer.old), 4)
+
+        log_name = './logs/nginx-access-ui.log-20170720_'
+        top_urls, report = log_analyzer.calculate_statistic(
+            log_analyzer.read_log(log_name, None), log_analyzer.regexprs["NGINX_REGEXP"], 100, 0,
+            url_normalizer=log_analyzer.UrlNormalizer(strip_query=True, replace_ids=True))
+        self.assertEquals(report['/api/v2/banner/{id}']["count"], 4)
+
+    def test_exact_accumulator(self):
+        accumulator = log_analyzer.ExactAccumulator()
+        for value in [0.3, 0.1, 0.4, 0.2]:
+            accumulator.add(value)
+        other = log_analyzer.ExactAccumulator()
+        other.add(0.5)
+        accumulator.merge(other)
+        self.assertEquals(accumulator.times.typecode, 'd')
+        count, time_sum, time_max, time_med = accumulator.summary()
+        self.assertEquals(count, 5)
+        self.assertAlmostEqual(time_sum, 1.5)
+        self.assertEquals(time_max, 0.5)
+        self.assertEquals(time_med, 0.3)
+        self.assertAlmostEqual(accumulator.time_sum, 1.5)
+
+        # Накопитель переживает сериализацию, а у сохранённых без текущей суммы она пересчитывается
+        restored = cPickle.loads(cPickle.dumps(accumulator, cPickle.HIGHEST_PROTOCOL))
+        self.assertEquals((list(restored.times), restored.time_sum), (list(accumulator.times), accumulator.time_sum))
+        restored = log_analyzer.ExactAccumulator.__new__(log_analyzer.ExactAccumulator)
+        restored.__setstate__((None, {"times": accumulator.times}))
+        self.assertAlmostEqual(restored.time_sum, 1.5)
+
+    def test_sketch_accumulator(self):
+        mapping = log_analyzer.SketchMapping(0.01, 2048)
+        accumulator = log_analyzer.SketchAccumulator(mapping)
+        values = [0.001 * i for i in range(1, 1001)]
+        for value in values:
+            accumulator.add(value)
+        count, time_sum, time_max, time_med = accumulator.summary()
+        self.assertEquals(count, 1000)
+        self.assertAlmostEqual(time_sum, sum(values))
+        self.assertEquals(time_max, 1.0)
+        self.assertLessEqual(abs(time_med - values[499]), 0.01 * values[499])
+
+        other = log_analyzer.SketchAccumulator(mapping)
+        other.add(0.0)
+        other.add(5.0)
+        accumulator.merge(other)
+        self.assertEquals(accumulator.count, 1002)
+        self.assertEquals(accumulator.time_max, 5.0)
+        self.assertEquals(accumulator.quantile(0), 0.0)
+
+        # Скетч с теми же параметрами (например, из хранилища) объединяется, с другой точностью - нет
+        accumulator.merge(cPickle.loads(cPickle.dumps(other, cPickle.HIGHEST_PROTOCOL)))
+        self.assertEquals(accumulator.count, 1004)
+        with self.assertRaises(ValueError):
+            accumulator.merge(log_analyzer.SketchAccumulator(log_analyzer.SketchMapping(0.2, 2048)))
+
+    def test_calculate_statistic_sketch(self):
+        log_name = './logs/nginx-access-ui.log-20170720_'
+        regexp = log_analyzer.regexprs["NGINX_REGEXP"]
+        factory = log_analyzer.get_accumulator_factory(
+            {"AGGREGATION": "sketch", "SKETCH_RELATIVE_ACCURACY": 0.01, "SKETCH_MAX_BUCKETS": 2048})
+        top_urls, report = log_analyzer.calculate_statistic(log_analyzer.read_log(log_name, None), regexp, 5, 0)
+        sk_top_urls, sk_report = log_analyzer.calculate_statistic(log_analyzer.read_log(log_name, None), regexp, 5, 0,
+                                                                  factory)
+        self.assertEquals(top_urls, sk_top_urls)
+        for url in top_urls:
+            self.assertEquals(report[url]["count"], sk_report[url]["count"])
+            self.assertEquals(report[url]["time_max"], sk_report[url]["time_max"])
+            self.assertLessEqual(abs(report[url]["time_med"] - sk_report[url]["time_med"]),
+                                 0.01 * report[url]["time_med"])
+
+    def test_aggregate_cache(self):
+        log_name = './logs/nginx-access-ui.log-20170720_'
+        partial = log_analyzer.collect_statistic(log_analyzer.read_log(log_name, None),
+                                                 log_analyzer.regexprs["NGINX_REGEXP"])
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cache = log_analyzer.AggregateCache(os.path.join(temp_dir, 'aggregates.sqlite'))
+            cache.put('log-20170720', 100, 1.5, 'exact', partial)
+            self.assertIsNone(cache.get('log-20170720', 101, 1.5, 'exact'))
+            self.assertIsNone(cache.get('log-20170720', 100, 1.5, 'sketch'))
+            cached = cache.get('log-20170720', 100, 1.5, 'exact')
+            cache.close()
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEquals(cached.requests_count, partial.requests_count)
+        self.assertEquals(cached.mismatch_count, partial.mismatch_count)
+        self.assertEquals(sorted(cached.urls), sorted(partial.urls))
+        self.assertEquals(list(cached.urls[u'/api/v2/banner/25019354'].times), [0.39])
+
+        # Статистика скетчей с другой точностью из хранилища не берётся
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cfg = log_analyzer.config.copy()
+            cfg.update({"LOG_DIR": './logs', "AGGREGATION": "sketch", "SKETCH_RELATIVE_ACCURACY": 0.2})
+            cache = log_analyzer.AggregateCache(os.path.join(temp_dir, 'aggregates.sqlite'))
+            nginx_log = log_analyzer.NginxLog('nginx-access-ui.log-20170720_', None, None)
+            for accuracy, cached_count in ((0.2, 0), (0.2, 1), (0.01, 0)):
+                cfg["SKETCH_RELATIVE_ACCURACY"] = accuracy
+                metrics = log_analyzer.Metrics()
+                log_analyzer.get_log_statistic(cfg, nginx_log, cache, metrics)
+                self.assertEquals(metrics.counters["logs_cached"], cached_count)
+            cache.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_log_follower(self):
+        temp_dir = tempfile.mkdtemp()
+        live_log = os.path.join(temp_dir, 'nginx-access-ui.log')
+        try:
+            with open(live_log, 'w') as log_file:
+                log_file.write(self.log_content[0] + '\n' + self.log_content[1][:20])
+            follower = log_analyzer.LogFollower(temp_dir, 'nginx-access-ui.log',
+                                                log_analyzer.regexprs["LOG_NAME_REGEXP"])
+            self.assertEquals([line.strip() for line in follower.read_new_lines()], self.log_content[:1])
+
+            with open(live_log, 'a') as log_file:
+                log_file.write(self.log_content[1][20:] + '\n')
+            self.assertEquals([line.strip() for line in follower.read_new_lines()], self.log_content[1:])
+            self.assertFalse(follower.rotated)
+
+            with open(live_log, 'a') as log_file:
+                log_file.write(self.log_content[0] + '\n')
+            os.rename(live_log, os.path.join(temp_dir, 'nginx-access-ui.log-20170721'))
+            with open(live_log, 'w') as log_file:
+                log_file.write(self.log_content[1] + '\n')
+            self.assertEquals([line.strip() for line in follower.read_new_lines()], self.log_content[:1])
+            self.assertTrue(follower.rotated)
+            self.assertEquals([line.strip() for line in follower.read_new_lines()], self.log_content[1:])
+
+            # Лог сразу сжат при ротации: хвост дочитывается из сжатого лога
+            with open(live_log, 'a') as log_file:
+                log_file.write(self.log_content[0] + '\n')
+            with open(live_log, 'rb') as log_file, gzip.open(os.path.join(temp_dir, 'nginx-access-ui.log-20170722.gz'),
+                                                               'wb') as gz_file:
+                gz_file.write(log_file.read())
+            # Новый файл создаётся до удаления старого, чтобы inode не переиспользовался
+            with open(live_log + '.new', 'w') as log_file:
+                log_file.write(self.log_content[1] + '\n')
+            os.rename(live_log + '.new', live_log)
+            self.assertEquals([line.strip() for line in follower.read_new_lines()], self.log_content[:1])
+            self.assertTrue(follower.rotated)
+            self.assertEquals([line.strip() for line in follower.read_new_lines()], self.log_content[1:])
+
+            checkpoint_file = os.path.join(temp_dir, 'follow.checkpoint')
+            log_analyzer.save_checkpoint(checkpoint_file, follower.inode, follower.offset, None)
+            self.assertEquals(log_analyzer.load_checkpoint(checkpoint_file),
+                              (os.stat(live_log).st_ino, os.path.getsize(live_log), None))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_stats_service(self):
+        temp_dir = tempfile.mkdtemp()
+        live_log = os.path.join(temp_dir, 'nginx-access-ui.log')
+        try:
+            with open(live_log, 'w') as log_file:
+                log_file.write(self.log_content[0] + '\n')
+            cfg = log_analyzer.config.copy()
+            cfg.update({"LOG_DIR": temp_dir, "FOLLOW_CHECKPOINT": os.path.join(temp_dir, 'follow.checkpoint'),
+                        "REPORT_TEMPLATE": './reports/report.html', "PARSER": "fast"})
+            service = log_analyzer.StatsService(cfg)
+            self.assertEquals(service.update(), 1)
+
+            server = log_analyzer.StatsServer(('127.0.0.1', 0), service)
+            server_thread = threading.Thread(target=server.serve_forever)
+            server_thread.daemon = True
+            server_thread.start()
+            base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+            try:
+                top = json.load(urllib2.urlopen(base_url + '/top'))
+                self.assertEquals([row["url"] for row in top], ['/api/v2/banner/25019354'])
+
+                with open(live_log, 'a') as log_file:
+                    log_file.write(self.log_content[1] + '\n' + self.log_content[0] + '\n')
+                # Итоговая статистика и статистика url считаются без блокировки, запросы в это время не ждут
+                finalize_statistic = log_analyzer.finalize_statistic
+                fill_statistic = log_analyzer.fill_statistic
+                locked = []
+
+                def check_lock(function):
+                    def wrapper(*args):
+                        free = service.lock.acquire(False)
+                        if free:
+                            service.lock.release()
+                        locked.append(not free)
+                        return function(*args)
+                    return wrapper
+
+                log_analyzer.finalize_statistic = check_lock(finalize_statistic)
+                try:
+                    self.assertEquals(service.update(), 2)
+                finally:
+                    log_analyzer.finalize_statistic = finalize_statistic
+                self.assertEquals(locked, [False])
+                self.assertEquals(len(json.load(urllib2.urlopen(base_url + '/top?limit=1'))), 1)
+                del locked[:]
+                log_analyzer.fill_statistic = check_lock(fill_statistic)
+                try:
+                    statistic = json.load(urllib2.urlopen(base_url + '/url?url=' + urllib.quote(
+                        '/api/1/photogenic_banners/list/?server_name=WIN7RB4')))
+                finally:
+                    log_analyzer.fill_statistic = fill_statistic
+                self.assertEquals(locked, [False])
+                self.assertEquals((statistic["count"], statistic["time_sum"]), (1, 0.133))
+                stats = json.load(urllib2.urlopen(base_url + '/stats'))
+                self.assertEquals((stats["requests_count"], stats["urls"]), (3, 2))
+                report = urllib2.urlopen(base_url + '/report').read()
+                self.assertIn('var table = [{', report)
+                self.assertNotIn('$table_json', report)
+                with self.assertRaises(urllib2.HTTPError) as context:
+                    urllib2.urlopen(base_url + '/url?url=/missing')
+                self.assertEquals(context.exception.code, 404)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+            # Контрольная точка пишется не при каждом обновлении, а раз в FOLLOW_CHECKPOINT_INTERVAL и при остановке
+            self.assertFalse(os.path.exists(cfg["FOLLOW_CHECKPOINT"]))
+            self.assertEquals(service.update(), 0)
+            service.save()
+            # Статистика переживает перезапуск через контрольную точку
+            self.assertEquals(log_analyzer.StatsService(cfg).summary()["requests_count"], 3)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_backfill(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            log_dir = os.path.join(temp_dir, 'log')
+            report_dir = os.path.join(temp_dir, 'reports')
+            os.mkdir(log_dir)
+            os.mkdir(report_dir)
+            for log_date in ('20170718', '20170719', '20170720'):
+                shutil.copy('./logs/nginx-access-ui.log-20170720', os.path.join(log_dir, 'nginx-access-ui.log-' +
+                                                                               log_date))
+            # Лог с неверным форматом не должен мешать обработке остальных
+            with open(os.path.join(log_dir, 'nginx-access-ui.log-20170717'), 'w') as log_file:
+                log_file.write('broken line\n')
+            open(os.path.join(report_dir, 'report-2017.07.20.html'), 'w').close()
+
+            unreported = log_analyzer.get_unreported_logs(log_dir, log_analyzer.regexprs["LOG_NAME_REGEXP"],
+                                                          report_dir)
+            self.assertEquals([log.name[-8:] for log in unreported], ['20170717', '20170718', '20170719'])
+
+            cfg = log_analyzer.config.copy()
+            cfg.update({"LOG_DIR": log_dir, "REPORT_DIR": report_dir, "REPORT_TEMPLATE": './reports/report.html',
+                        "LOGLEVEL": 50, "BACKFILL_WORKERS": 2})
+            results = log_analyzer.backfill(cfg)
+            self.assertEquals([result["success"] for result in results], [False, True, True])
+            self.assertTrue(os.path.isfile(os.path.join(report_dir, 'report-2017.07.19.html')))
+            self.assertTrue(os.path.isfile(os.path.join(report_dir, 'backfill-timings.json')))
+
+            # Процесс, упавший без результата (например, убитый при нехватке памяти), - не обработанный день
+            os.remove(os.path.join(report_dir, 'report-2017.07.19.html'))
+            build_report = log_analyzer.build_report
+            log_analyzer.build_report = lambda *args: os.kill(os.getpid(), signal.SIGKILL)
+            try:
+                results = log_analyzer.backfill(cfg)
+            finally:
+                log_analyzer.build_report = build_report
+            self.assertEquals([(result["log"][-8:], result["success"], result["exitcode"]) for result in results],
+                              [('20170717', False, -signal.SIGKILL), ('20170719', False, -signal.SIGKILL)])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_build_report_metrics(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cfg = log_analyzer.config.copy()
+            cfg.update({"LOG_DIR": './logs', "REPORT_TEMPLATE": './reports/report.html', "METRICS_FORMAT": "json",
+                        "REPORT_DIMENSIONS": ["status"], "REPORT_PERCENTILES": [95]})
+            nginx_log = log_analyzer.NginxLog('nginx-access-ui.log-20170720', datetime.datetime(2017, 7, 20), None)
+            report_name = os.path.join(temp_dir, 'report-2017.07.20.html')
+            self.assertTrue(log_analyzer.build_report(cfg, [nginx_log], report_name))
+
+            with open(os.path.join(temp_dir, 'report-2017.07.20.metrics.json')) as metrics_file:
+                metrics = json.load(metrics_file)
+            self.assertEquals(metrics["counters"]["lines"], 2)
+            self.assertEquals(metrics["counters"]["mismatches"], 0)
+            self.assertEquals(metrics["counters"]["distinct_urls"], 2)
+            self.assertEquals(metrics["counters"]["bytes_read"], os.path.getsize('./logs/nginx-access-ui.log-20170720'))
+            self.assertTrue(set(["read", "collect", "merge", "finalize", "report"]) <=
+                            set(metrics["phases"]))
+            self.assertTrue(metrics["peak_rss_kb"] > 0)
+            with io.open(os.path.join(temp_dir, 'report-2017.07.20-by-status.html'), encoding='utf-8') as table_file:
+                self.assertIn(u'"status": "200"', table_file.read())
+
+            cfg["METRICS_FORMAT"] = "prometheus"
+            os.remove(report_name)
+            self.assertTrue(log_analyzer.build_report(cfg, [nginx_log], report_name))
+            with open(os.path.join(temp_dir, 'report-2017.07.20.prom')) as metrics_file:
+                content = metrics_file.read()
+            self.assertIn('log_analyzer_phase_seconds{phase="collect"}', content)
+            self.assertIn('log_analyzer_lines_total 2\n', content)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_log_generator(self):
+        lines = list(log_generator.generate_lines(2000, urls=50, malformed_rate=0.05, seed=1))
+        self.assertEquals(lines, list(log_generator.generate_lines(2000, urls=50, malformed_rate=0.05, seed=1)))
+        self.assertEquals(len(lines), 2000)
+
+        statistic = log_analyzer.collect_statistic(iter(lines), log_analyzer.regexprs["NGINX_REGEXP"])
+        self.assertEquals(statistic.requests_count, 2000)
+        self.assertTrue(0 < statistic.mismatch_count < 200)
+        self.assertTrue(len(statistic.urls) <= 50)
+
+    def test_error_checks(self):
+        nginx_regex = log_analyzer.regexprs["NGINX_REGEXP"]
+        self.assertEquals(log_analyzer.errors_lower_bound(0, 1000, 4.0), 0.0)
+        self.assertTrue(0.05 < log_analyzer.errors_lower_bound(100, 1000, 4.0) < 0.1)
+
+        # Лог в чужом формате: обработка прерывается задолго до конца
+        read = []
+        broken_line = "1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] broken line {:06d}\n"
+
+        def broken_log():
+            for number in xrange(100000):
+                read.append(number)
+                yield broken_line.format(number)
+
+        monitor = log_analyzer.ErrorRateMonitor(1, len(broken_line.format(0)) * 100000)
+        with self.assertRaises(ValueError):
+            log_analyzer.collect_statistic(broken_log(), nginx_regex, error_monitor=monitor)
+        self.assertTrue(len(read) < 50000)
+
+        # Размер сжатого лога после распаковки не известен: граница доверительного интервала после min_lines строк
+        del read[:]
+        monitor = log_analyzer.ErrorRateMonitor(1, None, min_lines=1000)
+        with self.assertRaises(ValueError):
+            log_analyzer.collect_statistic(broken_log(), nginx_regex, error_monitor=monitor)
+        self.assertTrue(1000 <= len(read) < 1100)
+
+        # Пачка ошибок в одном месте при допустимой итоговой доле не прерывает обработку
+        lines = list(log_generator.generate_lines(20000, urls=50, malformed_rate=0, seed=2))
+        lines[1000:1100] = [broken_line.format(number) for number in xrange(100)]
+        monitor = log_analyzer.ErrorRateMonitor(1, sum(len(line) for line in lines))
+        statistic = log_analyzer.collect_statistic(iter(lines), nginx_regex, error_monitor=monitor)
+        self.assertEquals(statistic.mismatch_count, 100)
+
+        # Ошибки попадают в карантин не больше max_lines строк
+        temp_dir = tempfile.mkdtemp()
+        try:
+            lines = list(log_generator.generate_lines(5000, urls=50, malformed_rate=0.002, seed=2))
+            quarantine = log_analyzer.LineQuarantine(os.path.join(temp_dir, "bad"), max_lines=3)
+            statistic = log_analyzer.collect_statistic(iter(lines), nginx_regex, error_monitor=monitor,
+                                                       quarantine=quarantine)
+            quarantine.close()
+            self.assertTrue(statistic.mismatch_count > 3)
+            with open(os.path.join(temp_dir, "bad")) as quarantine_file:
+                bad_lines = quarantine_file.readlines()
+            self.assertEquals(len(bad_lines), 3)
+            self.assertTrue(all("broken line" in line for line in bad_lines))
+
+            # При параллельной обработке строки разных кусков не перемешиваются
+            log_name = os.path.join(temp_dir, "nginx-access-ui.log-20170629")
+            log_generator.generate_log(log_name, 20000, urls=50, malformed_rate=0.1, seed=4)
+            quarantine = log_analyzer.LineQuarantine(os.path.join(temp_dir, "bad-parallel"), max_lines=100000)
+            statistic = log_analyzer.collect_statistic_parallel(log_name, nginx_regex, 4, quarantine=quarantine)
+            with open(log_name) as log_file:
+                expected = [line for line in log_file if "broken line" in line]
+            with open(quarantine.path) as quarantine_file:
+                self.assertEquals(quarantine_file.readlines(), expected)
+            self.assertEquals(statistic.mismatch_count, len(expected))
+            self.assertEquals(os.listdir(temp_dir).count("bad-parallel"), 1)
+
+            # Куски параллельной обработки проверяют суммарную долю ошибок: по отдельности ни один кусок
+            # не набирает достаточно несовпадений для остановки
+            with open(log_name, 'w') as log_file:
+                log_file.writelines(broken_line.format(number).rstrip('\n') + ' ' * 140 + '\n'
+                                    for number in xrange(20000))
+            monitor = log_analyzer.ErrorRateMonitor(1, os.path.getsize(log_name))
+            with self.assertRaises(ValueError):
+                log_analyzer.collect_statistic_parallel(log_name, nginx_regex, 8, error_monitor=monitor)
+
+            # Проверка по выборке читает строки из разных мест файла
+            log_name = os.path.join(temp_dir, "nginx-access-ui.log-20170630")
+            log_generator.generate_log(log_name, 20000, urls=50, malformed_rate=0.002, seed=3)
+            sample = log_analyzer.sample_log_lines(log_name, None, 1600, decode=False)
+            self.assertEquals(len(sample), 1600)
+            self.assertTrue(any("-4708-19" in line for line in sample))
+            self.assertTrue(log_analyzer.preflight_log(log_name, None, nginx_regex, "fast", 1600, 1) < 1)
+
+            with open(log_name, 'w') as log_file:
+                log_file.writelines("broken line {}\n".format(number) for number in xrange(20000))
+            with self.assertRaises(ValueError):
+                log_analyzer.preflight_log(log_name, None, nginx_regex, "fast", 1600, 1)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_calculate_statistic_dimensions(self):
+        log_content = self.log_content + [
+            '1.1.1.1 -  - [29/Jun/2017:04:20:00 +0300] "POST /api/v2/banner/25019354 HTTP/1.1" 502 12 "-" "-" "-"'
+            ' "1498697422-1-4708-1" "-" 0.900',
+            '1.1.1.1 -  - [29/Jun/2017:04:40:00 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 12 "-" "-" "-"'
+            ' "1498697422-1-4708-2" "-" 0.610']
+        dimensions = log_analyzer.Dimensions(["status_class", "method+time_bucket"], time_bucket=30)
+        self.assertEquals(dimensions.names, ["status_class", "method-time_bucket"])
+
+        top_urls, report, tables = log_analyzer.calculate_statistic(
+            iter(log_content), log_analyzer.regexprs["NGINX_REGEXP"], 10, 0, percentiles=[50, 99],
+            dimensions=dimensions)
+        banner = '/api/v2/banner/25019354'
+        self.assertEquals(top_urls[0], banner)
+        self.assertEquals(report[banner]["count"], 3)
+        self.assertEquals(report[banner]["time_p50"], 0.61)
+        self.assertEquals(report[banner]["time_p99"], 0.61)
+
+        by_status, by_method_time = tables
+        self.assertEquals([(row["status_class"], row["url"], row["count"]) for row in by_status],
+                          [("2xx", banner, 2), ("5xx", banner, 1), ("2xx", top_urls[1], 1)])
+        self.assertAlmostEqual(by_status[0]["time_sum"], 1.0)
+        self.assertEquals(sorted((row["method"], row["time_bucket"], row["count"]) for row in by_method_time),
+                          [("GET", "03:30", 1), ("GET", "03:30", 1), ("GET", "04:30", 1), ("POST", "04:00", 1)])
+        self.assertEquals(by_method_time[0]["count_perc"], 25.0)
+
+        # Группировки так же объединяются для кусков лога и совпадают с подсчётом за один проход
+        partials = [log_analyzer.collect_statistic(iter(log_content[:2]), None, dimensions=dimensions),
+                    log_analyzer.collect_statistic(iter(log_content[2:]), None, dimensions=dimensions)]
+        self.assertEquals(log_analyzer.finalize_groups(log_analyzer.merge_statistics(partials), dimensions, 10),
+                          log_analyzer.finalize_groups(log_analyzer.collect_statistic(
+                              iter(log_content), None, dimensions=dimensions), dimensions, 10))
+
+        sketch_factory = log_analyzer.get_accumulator_factory(
+            {"AGGREGATION": "sketch", "SKETCH_RELATIVE_ACCURACY": 0.01, "SKETCH_MAX_BUCKETS": 2048})
+        top_urls, report = log_analyzer.calculate_statistic(iter(log_content), log_analyzer.regexprs["NGINX_REGEXP"],
+                                                            10, 0, sketch_factory, percentiles=[99])
+        self.assertAlmostEqual(report[banner]["time_p99"], 0.61, delta=0.61 * 0.01)
+
+        self.assertRaises(ValueError, log_analyzer.Dimensions, ["status+user_agent"])
+
+    def test_columns(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            log_name = os.path.join(temp_dir, 'nginx-access-ui.log-20170630.gz')
+            late_post = self.log_content[0].replace('"GET', '"POST').replace('03:50', '23:59')
+            log_content = self.log_content * 3 + ['broken line', late_post]
+            with gzip.open(log_name, 'wb') as log_file:
+                log_file.write("\n".join(log_content) + "\n")
+            columns_dir = os.path.join(temp_dir, 'columns', 'nginx-access-ui.log-20170630.gz')
+            meta = log_analyzer.convert_log(log_name, '.gz', columns_dir, chunk_rows=2)
+            self.assertEquals((meta["lines"], meta["rows"], meta["mismatches"]), (8, 7, 1))
+            self.assertEquals(meta["utc_offset"], "+0300")
+            self.assertFalse(os.path.exists(columns_dir + ".tmp"))
+
+            chunks = list(log_analyzer.iter_columns(columns_dir, ["times_ms", "timestamps"], chunk_rows=3))
+            self.assertEquals([len(columns["times_ms"]) for columns in chunks], [3, 3, 1])
+            self.assertEquals(list(chunks[0]["times_ms"])[:2], [390, 133])
+            self.assertEquals(chunks[0]["timestamps"][0] % 86400, 3 * 3600 + 50 * 60 + 22)
+
+            dimensions = log_analyzer.Dimensions(["status", "method+time_bucket"])
+            expected = log_analyzer.collect_statistic(iter(log_content), None, dimensions=dimensions)
+            partial = log_analyzer.collect_statistic_columns(columns_dir, dimensions=dimensions, chunk_rows=3)
+            self.assertEquals(log_analyzer.finalize_statistic(partial, 10, 20, [95]),
+                              log_analyzer.finalize_statistic(expected, 10, 20, [95]))
+            self.assertEquals(log_analyzer.finalize_groups(partial, dimensions, 10),
+                              log_analyzer.finalize_groups(expected, dimensions, 10))
+
+            # Статистика лога берётся из колоночной копии, пока лог не изменился
+            cfg = log_analyzer.config.copy()
+            cfg.update({"LOG_DIR": temp_dir, "COLUMNS_DIR": os.path.join(temp_dir, 'columns'),
+                        "URL_REPLACE_IDS": True})
+            nginx_log = log_analyzer.NginxLog('nginx-access-ui.log-20170630.gz', datetime.datetime(2017, 6, 30), '.gz')
+            metrics = log_analyzer.Metrics()
+            partial = log_analyzer.get_log_statistic(cfg, nginx_log, metrics=metrics)
+            self.assertEquals(metrics.counters["logs_columns"], 1)
+            self.assertEquals(partial.urls['/api/v2/banner/{id}'].summary()[0], 4)
+            os.utime(log_name, (0, 0))
+            self.assertIsNone(log_analyzer.load_columns_meta(columns_dir, os.stat(log_name)))
+
+            # При PARSER = regex url словаря декодируются, как и при разборе декодированных строк лога
+            with gzip.open(log_name, 'wb') as log_file:
+                log_file.write(self.log_content[0].replace('/api/v2/banner/25019354', '/поиск') + "\n")
+            log_analyzer.convert_log(log_name, '.gz', columns_dir)
+            partial = log_analyzer.collect_statistic_columns(columns_dir, decode=True)
+            self.assertEquals(partial.urls.keys(), [u'/поиск'])
+            partial = log_analyzer.collect_statistic_columns(columns_dir)
+            self.assertEquals(partial.urls.keys(), [u'/поиск'.encode('utf-8')])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_write_report(self):
+        partial = log_analyzer.collect_statistic(iter(self.log_content), log_analyzer.regexprs["NGINX_REGEXP"])
+        top_urls, report = log_analyzer.finalize_statistic(partial, 10, 100)
+        self.assertEquals("".join(log_analyzer.iter_report_json(top_urls, report)),
+                          log_analyzer.serialize_report_dict(top_urls, report))
+        self.assertEquals("".join(log_analyzer.iter_report_json([], {})), "[]")
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            template_name = os.path.join(temp_dir, 'template.html')
+            template_text = u'<p>$$price $$table_json $header</p><script>var table = ${table_json};</script>\n'
+            with io.open(template_name, mode='w', encoding='utf-8') as template_file:
+                template_file.write(template_text)
+            report_name = os.path.join(temp_dir, 'report.html')
+            self.assertTrue(log_analyzer.write_report(template_name, report_name,
+                                                      log_analyzer.iter_report_json(top_urls, report)))
+            with io.open(report_name, mode='r', encoding='utf-8') as report_file:
+                expected = Template(template_text).safe_substitute(
+                    table_json=log_analyzer.serialize_report_dict(top_urls, report))
+                self.assertEquals(report_file.read(), expected)
+            # Уже существующий отчёт не перезаписывается
+            self.assertFalse(log_analyzer.write_report(template_name, report_name, ["[]"]))
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_generate_report(self):
         self.assertTrue(log_analyzer.generate_report('./reports/report.html', './reports/report_NEW.html',
                                                      self.serialized_dict))
@@ -4,6 +4,8 @@
 from setuptools import setup
 
 install_requires = [
+    # Бэкпорт os.scandir: без него папка с логами просматривается через os.listdir
+    'scandir; python_version < "3.5"',
     ]
 
 setup(